@@ -9,6 +9,7 @@ import atexit
 import cmd
 import datetime
 import getpass
+import glob
 import logging
 import os
 import pwd
@@ -18,10 +19,14 @@ import signal
 import string
 import subprocess
 import sys
+import time
 import yaml
 
 from m2ee import pgutil, M2EE, client_errno
 import m2ee
+import m2ee.agent
+import m2ee.openmetrics
+import m2ee.sampling
 
 logger = logging
 
@@ -285,13 +290,18 @@ class CLI(cmd.Cmd, object):
         if status != 'running':
             return
 
-        critlist = self.m2ee.client.get_critical_log_messages()
+        max_show_users = 10
+        async_client = m2ee.client.AsyncM2EEClient(self.m2ee.client)
+        critlist, feedback = m2ee.client.gather([
+            async_client.get_critical_log_messages(),
+            async_client.get_logged_in_user_names({"limit": max_show_users}),
+        ])
+
         if len(critlist) > 0:
             logger.error("%d critical error(s) were logged. Use show_critical"
                          "_log_messages to view them." % len(critlist))
 
-        max_show_users = 10
-        total_users = self._who(max_show_users)
+        total_users = self._print_who(feedback)
         if total_users > max_show_users:
             logger.info("Only showing %s logged in users. Use who to see a "
                         "complete list." % max_show_users)
@@ -331,6 +341,7 @@ class CLI(cmd.Cmd, object):
             logger.error("Unexpected health check status: %s" % feedback['health'])
 
     def do_statistics(self, args):
+        # always fresh, and complete, unlike the shared snapshot for munin
         stats = self.m2ee.client.runtime_statistics()
         stats.update(self.m2ee.client.server_statistics())
         print(yaml.safe_dump(stats, default_flow_style=False))
@@ -339,7 +350,26 @@ class CLI(cmd.Cmd, object):
         stats = self.m2ee.client.cache_statistics()
         print(yaml.safe_dump(stats, default_flow_style=False))
 
+    def do_client_stats(self, args):
+        summary = self.m2ee.client.statistics.summary()
+        if len(summary) == 0:
+            logger.info("No admin requests have been sent yet.")
+            return
+        print("%-32s %7s %7s %7s %9s %9s %9s %9s" %
+              ("action", "count", "errors", "timeout", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+        for action in sorted(summary.keys()):
+            stats = summary[action]
+            print("%-32s %7d %7d %7d %9.1f %9.1f %9.1f %9.1f" %
+                  (action, stats['count'], stats['errors'], stats['timeouts'],
+                   stats['p50_ms'], stats['p90_ms'], stats['p99_ms'], stats['max_ms']))
+
     def do_munin_config(self, args):
+        if m2ee.munin.dirtyconfig_supported():
+            m2ee.munin.print_config_and_values(
+                self.m2ee,
+                self.prompt_username,
+            )
+            return
         m2ee.munin.print_config(
             self.m2ee,
             self.prompt_username,
@@ -351,11 +381,95 @@ class CLI(cmd.Cmd, object):
             self.prompt_username,
         )
 
+    def do_agent(self, args):
+        interval = self.m2ee.config.get_munin_options().get('agent_interval', 300)
+        if args:
+            try:
+                interval = int(args)
+            except ValueError:
+                logger.error("Could not parse argument to an integer. Use a number "
+                             "of seconds as argument to set the sample interval.")
+                return
+        agent = m2ee.agent.M2EEAgent(
+            self.m2ee,
+            self.prompt_username,
+            m2ee.munin.get_spool_dir(self.m2ee),
+            interval,
+        )
+        try:
+            agent.run()
+        except KeyboardInterrupt:
+            logger.info("Stopped collecting statistics.")
+
+    def do_exporter(self, args):
+        options = self.m2ee.config.get_openmetrics_options()
+        port = options.get('port', 9393)
+        if args:
+            try:
+                port = int(args)
+            except ValueError:
+                logger.error("Could not parse argument to an integer. Use a port "
+                             "number as argument.")
+                return
+        exporter = m2ee.openmetrics.M2EEMetricsExporter(
+            self.m2ee,
+            host=options.get('listen', '127.0.0.1'),
+            port=port,
+            interval=options.get('interval', 15),
+        )
+        try:
+            exporter.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Stopped serving metrics.")
+
+    def do_record(self, args):
+        try:
+            duration, interval = [float(x) for x in args.split()[:2]]
+            filename = args.split()[2] if len(args.split()) > 2 else None
+        except ValueError:
+            logger.error("Use the duration and interval of sampling in seconds as "
+                         "arguments, e.g. record 60 0.25, optionally followed by a "
+                         "file name.")
+            return
+        if duration < 0:
+            logger.error("The duration can not be negative.")
+            return
+        if interval <= 0:
+            logger.error("The interval needs to be positive.")
+            return
+        if filename is None:
+            filename = os.path.join(
+                self.m2ee.config.get_default_dotm2ee_directory(),
+                time.strftime("statistics-%Y%m%d-%H%M%S.json.gz"))
+        logger.info("Recording statistics every %s seconds during %s seconds to %s" %
+                    (interval, duration, filename))
+        recorder = m2ee.sampling.M2EEStatisticsRecorder(self.m2ee, filename)
+        try:
+            count = recorder.record(duration, interval)
+            logger.info("Recorded %d samples, use report %s to show them." %
+                        (count, filename))
+        except KeyboardInterrupt:
+            logger.info("Stopped recording statistics, use report %s to show them." %
+                        filename)
+
+    def do_report(self, args):
+        filename = args.strip()
+        if not filename:
+            recordings = sorted(glob.glob(os.path.join(
+                self.m2ee.config.get_default_dotm2ee_directory(),
+                "statistics-*.json.gz")))
+            if not recordings:
+                logger.error("No statistics recordings found, use record to create one.")
+                return
+            filename = recordings[-1]
+        m2ee.sampling.print_report(filename)
+
     def do_nagios(self, args):
         logger.info("The nagios plugin will exit m2ee after running, this is "
                     "by design, don't report it as bug.")
         # TODO: implement as separate program after libraryfying m2ee
-        sys.exit(m2ee.nagios.check(self.m2ee.runner, self.m2ee.client))
+        sys.exit(m2ee.nagios.check(self.m2ee.runner, self.m2ee.client,
+                                   self.m2ee.snapshot_cache))
 
     def do_about(self, args):
         print('Using m2ee-tools version %s' % m2ee.__version__)
@@ -545,10 +659,29 @@ class CLI(cmd.Cmd, object):
         if not self.m2ee.config.is_using_postgresql():
             logger.error("Only PostgreSQL databases are supported right now.")
             return
-        if len(args) > 0:
-            pgutil.dumpdb(self.m2ee.config, args)
-        else:
-            pgutil.dumpdb(self.m2ee.config)
+        name = None
+        jobs = None
+        compression = None
+        words = args.split()
+        try:
+            while words:
+                word = words.pop(0)
+                if word == '-j':
+                    jobs = int(words.pop(0))
+                elif word == '-Z':
+                    compression = int(words.pop(0))
+                elif name is None:
+                    name = word
+                else:
+                    raise ValueError(word)
+        except (IndexError, ValueError):
+            logger.error("Usage: dumpdb [-j <jobs>] [-Z <compression level>] [<name>]")
+            return
+        # find out about wrong arguments or options before dumping anything
+        jobs, compression, compressor = pgutil.get_dump_options(
+            self.m2ee.config, jobs, compression)
+        pgutil.dumpdb(self.m2ee.config, name, jobs=jobs, compression=compression,
+                      compressor=compressor or 'none')
 
     def do_restoredb(self, args):
         if not self.m2ee.config.allow_destroy_db():
@@ -559,10 +692,22 @@ class CLI(cmd.Cmd, object):
         if not self.m2ee.config.is_using_postgresql():
             logger.error("Only PostgreSQL databases are supported right now.")
             return
-        if not args:
+        words = args.split()
+        jobs = None
+        try:
+            if words[:1] == ['-j']:
+                jobs = int(words[1])
+                words = words[2:]
+        except (IndexError, ValueError):
+            logger.error("Usage: restoredb [-j <jobs>] <name>")
+            return
+        if len(words) != 1:
             logger.error("restoredb needs the name of a dump file in %s as arg"
                          "ument" % self.m2ee.config.get_database_dump_path())
             return
+        if jobs is not None and jobs < 1:
+            logger.error("The amount of jobs needs to be at least 1.")
+            return
         (pid_alive, m2ee_alive) = self.m2ee.check_alive()
         if pid_alive or m2ee_alive:
             logger.warn("The application is still running, refusing to "
@@ -575,16 +720,17 @@ class CLI(cmd.Cmd, object):
         if answer != 'y':
             logger.info("Aborting!")
             return
-        pgutil.restoredb(self.m2ee.config, args)
+        pgutil.restoredb(self.m2ee.config, words[0], jobs=jobs)
 
     def complete_restoredb(self, text, line, begidx, endidx):
         if not self.m2ee.config.is_using_postgresql():
             return []
         database_dump_path = self.m2ee.config.get_database_dump_path()
         return [f for f in os.listdir(database_dump_path)
-                if os.path.isfile(os.path.join(database_dump_path, f)) and
-                f.startswith(text) and
-                f.endswith(".backup")]
+                if f.startswith(text) and
+                ((os.path.isfile(os.path.join(database_dump_path, f)) and
+                  f.endswith((".backup", ".sql", ".gz", ".zst"))) or
+                 os.path.isfile(os.path.join(database_dump_path, f, "toc.dat")))]
 
     def do_emptydb(self, args):
         if not self.m2ee.config.allow_destroy_db():
@@ -724,9 +870,10 @@ class CLI(cmd.Cmd, object):
             print(yaml.safe_dump(feedback, default_flow_style=False))
 
     def do_show_all_thread_stack_traces(self, args):
-        feedback = self.m2ee.client.get_all_thread_stack_traces()
+        stream = self.m2ee.client.iter_all_thread_stack_traces()
         print("Current JVM Thread Stacktraces:")
-        print(yaml.safe_dump(feedback, default_flow_style=False))
+        for thread, stacktrace in stream:
+            print(yaml.safe_dump({thread: stacktrace}, default_flow_style=False), end='')
 
     def do_interrupt_request(self, args):
         if args == "":
@@ -811,7 +958,12 @@ class CLI(cmd.Cmd, object):
         limit = {}
         if limitint is not None:
             limit = {"limit": limitint}
-        feedback = self.m2ee.client.get_logged_in_user_names(limit)
+        stream = self.m2ee.client.request_stream("get_logged_in_user_names",
+                                                 limit, path=('users',))
+        users = [user for _, user in stream]
+        return self._print_who({'count': stream.other['count'], 'users': users})
+
+    def _print_who(self, feedback):
         logger.info("Logged in users: (%s) %s" %
                     (feedback['count'], feedback['users']))
         return feedback['count']
@@ -903,9 +1055,13 @@ Available commands:
         if self.m2ee.config.is_using_postgresql():
             print("""When using PostgreSQL, you can also use:
  psql - start the postgresql shell
- dumpdb - create a database dump into the data/database folder
+ dumpdb [-j <jobs>] [-Z <level>] [<name>] - create a database dump into the
+     data/database folder, using multiple parallel jobs and a directory
+     instead of a single file when jobs is more than 1
  emptydb - drop all tables and sequences from the database
- restoredb - restore a database dump from the data/database folder
+ restoredb [-j <jobs>] <name> - restore a database dump from the data/database
+     folder, using multiple parallel jobs if possible, after verifying its
+     checksum if it has one
 """)
 
         if args == 'expert':
@@ -913,6 +1069,7 @@ Available commands:
  statistics - show all application statistics that can be used for monitoring
  show_all_thread_stack_traces - show all low-level JVM threads with stack trace
  check_health - manually execute health check
+ client_stats - show response times of admin requests done by this m2ee session
 
 Extra commands you probably don't need:
  debug - dive into a local python debug session inside this program
@@ -921,6 +1078,14 @@ Extra commands you probably don't need:
  reload - reload configuration from yaml files (this is done automatically)
  munin_config - configure option for the built-in munin plugin
  munin_values - show monitoring output gathered by the built-in munin plugin
+ agent [<interval>] - keep running and write munin statistics to the munin
+     spool directory every interval seconds
+ exporter [<port>] - keep running and serve statistics over http in the
+     OpenMetrics format for Prometheus
+ record <duration> <interval> [<file>] - sample statistics every interval
+     seconds (e.g. 0.25) during duration seconds, and write them to a file
+ report [<file>] - show rates and percentiles of recorded statistics, by default
+     from the most recent recording
  nagios - execute the built-in nagios plugin (will exit m2ee)
  activate_license - DANGEROUS - replace/set license key
 """)
@@ -0,0 +1,72 @@
+#
+# Copyright (C) 2009 Mendix. All rights reserved.
+#
+
+import logging
+import os
+import re
+import time
+
+import m2ee.munin
+from m2ee import util
+
+logger = logging.getLogger(__name__)
+
+_value_line = re.compile(r'^(\S+\.value) (\S+)$', re.MULTILINE)
+
+
+class M2EEAgent:
+    """
+    Collects the munin statistics of an application on its own schedule,
+    and writes the rendered output of the munin plugin into a spool
+    directory. The munin/mxruntime_ plugin only needs to read those files
+    then, instead of talking to the application on every run.
+
+    Values are written with the time they were sampled, so munin stores them
+    at the right moment, even when the plugin runs a bit later. The config
+    output only changes when the application changes, so it is only rendered
+    again every config_every samples.
+
+    The spool only holds the last sample, so sampling more often than munin
+    polls (every 5 minutes by default) only adds load on the application.
+    """
+
+    def __init__(self, m2, name, spool_dir, interval=300, config_every=10):
+        self._m2 = m2
+        self._name = name
+        self._spool_dir = spool_dir
+        self._interval = interval
+        self._config_every = config_every
+        self._samples = 0
+        self._config = None
+
+    def sample(self):
+        now = int(time.time())
+        # config and values are rendered from the same statistics
+        values = m2ee.munin.get_values(self._m2)
+        if self._samples % self._config_every == 0:
+            self._config = m2ee.munin.config_text(self._m2, self._name,
+                                                  values['config_stats'])
+        # also rewrite an unchanged config, so its age shows the agent is alive
+        self._write('config', self._config)
+        text = m2ee.munin.values_text(self._m2, self._name, values)
+        self._write('values', _value_line.sub(r'\1 %d:\2' % now, text))
+        self._samples += 1
+
+    def _write(self, kind, text):
+        if not os.path.isdir(self._spool_dir):
+            os.makedirs(self._spool_dir)
+        # never let the plugin see a half written file
+        util.write_atomically(os.path.join(self._spool_dir, kind), text)
+
+    def run(self):
+        logger.info("Writing munin statistics to %s every %s seconds" %
+                    (self._spool_dir, self._interval))
+        while True:
+            start = time.time()
+            try:
+                self._m2.reload_config_if_changed()
+                self.sample()
+            except Exception as e:
+                logger.error("Collecting statistics failed: %s" % e)
+            time.sleep(max(0, self._interval - (time.time() - start)))
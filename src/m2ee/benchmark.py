@@ -0,0 +1,212 @@
+#
+# Copyright (C) 2009 Mendix. All rights reserved.
+#
+
+from __future__ import print_function
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+from m2ee.client import M2EEClient
+from m2ee.core import M2EE
+from m2ee.testing import FakeAdminServer
+import m2ee.munin
+import m2ee.nagios
+
+logger = logging.getLogger(__name__)
+
+PASSWORD = "benchmark"
+
+
+def summarize(name, durations, elapsed=None):
+    """
+    Returns a dict with the amount of calls, calls per second and latency
+    percentiles in milliseconds for a list of durations in seconds.
+    """
+    durations = sorted(durations)
+    if elapsed is None:
+        elapsed = sum(durations)
+
+    def percentile(p):
+        return durations[min(len(durations) - 1, int(len(durations) * p / 100.0))] * 1000
+
+    return {
+        "name": name,
+        "calls": len(durations),
+        "per_second": len(durations) / elapsed if elapsed > 0 else 0,
+        "p50_ms": percentile(50),
+        "p99_ms": percentile(99),
+        "max_ms": durations[-1] * 1000,
+    }
+
+
+def benchmark_client(client, action="runtime_status", requests=1000, concurrency=1):
+    """
+    Does the admin request action the given amount of times, spread over the
+    given amount of threads, and returns the throughput and latency.
+    """
+    durations = []
+    lock = threading.Lock()
+
+    def work(amount):
+        mine = []
+        for i in range(amount):
+            start = time.time()
+            client.request(action, timeout=30)
+            mine.append(time.time() - start)
+        with lock:
+            durations.extend(mine)
+
+    threads = [
+        threading.Thread(target=work, args=(requests // concurrency +
+                                            (1 if i < requests % concurrency else 0),))
+        for i in range(concurrency)
+    ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize("%s (concurrency %d)" % (action, concurrency), durations,
+                     time.time() - start)
+
+
+def benchmark_function(name, function, repeat=100):
+    """
+    Calls function repeatedly, while discarding everything it prints, and
+    returns how long it took.
+    """
+    durations = []
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            for i in range(repeat):
+                start = time.time()
+                function()
+                durations.append(time.time() - start)
+        finally:
+            sys.stdout = stdout
+    return summarize(name, durations)
+
+
+def create_m2ee(server, app_base):
+    """
+    Sets up a minimal application directory that points to the admin API of
+    the given FakeAdminServer and returns an M2EE object for it. The pidfile
+    contains the pid of the current process, so the application looks alive.
+    """
+    for directory in ('model', 'web', 'data', '.m2ee'):
+        os.makedirs(os.path.join(app_base, directory))
+    about = server.feedback['about']
+    with open(os.path.join(app_base, 'model', 'metadata.json'), 'w') as f:
+        json.dump({"RuntimeVersion": about['version'], "Constants": []}, f)
+    pidfile = os.path.join(app_base, '.m2ee', 'm2ee.pid')
+    with open(pidfile, 'w') as f:
+        f.write("%s\n" % os.getpid())
+    config = {
+        "m2ee": {
+            "app_name": "benchmark",
+            "app_base": app_base,
+            "admin_port": server.port,
+            "admin_pass": PASSWORD,
+            "runtime_port": 8000,
+            "pidfile": pidfile,
+            # keep all state files away from the .m2ee directory of the user,
+            # which can contain the state of real applications
+            "capability_cache": os.path.join(app_base, '.m2ee', 'capability-cache.json'),
+            "admin_circuit_breaker": {
+                "file": os.path.join(app_base, '.m2ee', 'circuit-breaker.json'),
+            },
+            "munin": {
+                "config_text_cache": os.path.join(app_base, '.m2ee', 'munin-config.json'),
+            },
+            # measure the admin requests, instead of reusing their results
+            "snapshot_cache": {
+                "file": os.path.join(app_base, '.m2ee', 'snapshot-cache.json'),
+                "ttl": 0,
+            },
+        },
+        "mxruntime": {},
+        "logging": [],
+    }
+    yaml_file = os.path.join(app_base, 'm2ee.yaml')
+    with open(yaml_file, 'w') as f:
+        yaml.safe_dump(config, f)
+    return M2EE(yaml_files=[yaml_file])
+
+
+def run(payload_size=10, latency=0.0, requests=1000, concurrency=(1, 8), repeat=100):
+    """
+    Runs all benchmarks against a FakeAdminServer and returns the results as
+    a list of dicts.
+    """
+    results = []
+    app_base = tempfile.mkdtemp(prefix='m2ee-benchmark-')
+    with FakeAdminServer(PASSWORD, latency=latency, payload_size=payload_size) as server:
+        try:
+            client = M2EEClient(server.url, PASSWORD)
+            for threads in concurrency:
+                results.append(benchmark_client(client, "runtime_status", requests, threads))
+            results.append(benchmark_client(client, "get_all_thread_stack_traces",
+                                            max(1, requests // 10), 1))
+            client.close()
+
+            m2 = create_m2ee(server, app_base)
+            results.append(benchmark_function(
+                "munin.print_values",
+                lambda: m2ee.munin.print_values(m2, 'benchmark'), repeat))
+            results.append(benchmark_function(
+                "nagios.check",
+                lambda: m2ee.nagios.check(m2.runner, m2.client), repeat))
+            m2.client.close()
+        finally:
+            shutil.rmtree(app_base)
+    return results
+
+
+def print_results(results):
+    print("%-45s %8s %10s %9s %9s %9s" %
+          ("benchmark", "calls", "calls/s", "p50 ms", "p99 ms", "max ms"))
+    for result in results:
+        print("%-45s %8d %10.1f %9.2f %9.2f %9.2f" %
+              (result['name'], result['calls'], result['per_second'],
+               result['p50_ms'], result['p99_ms'], result['max_ms']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the admin API client, munin and nagios code of "
+        "m2ee-tools against a fake admin API.")
+    parser.add_argument("--payload-size", type=int, default=10,
+                        help="amount of threads, users etc. in responses")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds the fake admin API waits before responding")
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="amount of admin requests per client benchmark")
+    parser.add_argument("--concurrency", type=int, nargs='+', default=[1, 8],
+                        help="amounts of concurrent client threads to try")
+    parser.add_argument("--repeat", type=int, default=100,
+                        help="amount of munin and nagios runs")
+    parser.add_argument("--json", action="store_true",
+                        help="print results as json")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+    results = run(args.payload_size, args.latency, args.requests,
+                  args.concurrency, args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,28 @@
 #
 
 from base64 import b64encode
+import bisect
+import copy
+import fcntl
 import json
 import logging
+import os
 import socket
+import threading
+import time
+
+from m2ee import util
+from m2ee.jsonstream import JSONStreamReader, iter_items
 
 logger = logging.getLogger(__name__)
 
+try:
+    import httplib
+    from urlparse import urlparse
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlparse
+
 try:
     import httplib2
 except ImportError:
@@ -17,39 +33,461 @@ except ImportError:
     raise
 
 
+class M2EEConnectionPool:
+    """
+    Keeps httplib2.Http objects, and with them the keep-alive connections to
+    the admin port, around for reuse by subsequent requests.
+
+    An Http object is never shared between two requests running at the same
+    time. Connections which are inherited by a forked child process can not be
+    used by both processes, so the pool starts empty again as soon as it's
+    used in a process with another pid than the one which filled it.
+    """
+
+    def __init__(self, maxsize=4):
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._idle = {}
+
+    def acquire(self, timeout):
+        with self._lock:
+            self._check_pid()
+            idle = self._idle.get(timeout)
+            if idle:
+                return idle.pop()
+        logger.trace("Creating new admin API connection, timeout=%s" % timeout)
+        return httplib2.Http(timeout=timeout, proxy_info=None)
+
+    def release(self, h, timeout, reusable=True):
+        with self._lock:
+            if reusable and not self._check_pid():
+                idle = self._idle.setdefault(timeout, [])
+                if len(idle) < self._maxsize:
+                    idle.append(h)
+                    return
+        close_http(h)
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for h in [h for hs in idle.values() for h in hs]:
+            close_http(h)
+
+    def _check_pid(self):
+        pid = os.getpid()
+        if pid == self._pid:
+            return False
+        # Don't close anything here, the sockets are still in use by the
+        # parent process.
+        logger.trace("Process id changed from %s to %s, discarding admin API "
+                     "connections." % (self._pid, pid))
+        self._idle = {}
+        self._pid = pid
+        return True
+
+
+def close_http(h):
+    for conn in list(h.connections.values()):
+        conn.close()
+    h.connections.clear()
+
+
+class M2EECapabilityCache:
+    """
+    Remembers the admin actions and about information that a Mendix Runtime
+    provides. This information does not change during the lifetime of the
+    JVM process, so it's stored in a file, keyed by the JVM pid and the
+    runtime version, to be reused by subsequent invocations of m2ee, like the
+    munin and nagios plugins. The get_key function returns the key for the
+    currently running JVM, or None if there is none.
+    """
+
+    def __init__(self, filename, get_key):
+        self._filename = filename
+        self._get_key = get_key
+        self._key = None
+        self._capabilities = None
+
+    def get(self):
+        key = self._get_key()
+        if key is None:
+            return None
+        if self._key != key:
+            self._key, self._capabilities = key, self._read(key)
+        return self._capabilities
+
+    def store(self, capabilities):
+        key = self._get_key()
+        if key is None:
+            return
+        self._key, self._capabilities = key, capabilities
+        logger.debug("Writing admin capability cache to %s" % self._filename)
+        try:
+            util.write_atomically(self._filename, json.dumps(
+                {'key': key, 'capabilities': capabilities}))
+        except (IOError, OSError) as e:
+            logger.error("Error writing admin capability cache %s: %s" % (self._filename, e))
+
+    def _read(self, key):
+        try:
+            with open(self._filename) as f:
+                cached = json.load(f)
+        except IOError as e:
+            logger.trace("Unable to read admin capability cache %s: %s" % (self._filename, e))
+            return None
+        except ValueError as e:
+            logger.debug("Ignoring invalid admin capability cache %s: %s" % (self._filename, e))
+            return None
+        if cached.get('key') != key:
+            logger.trace("Admin capability cache %s is outdated" % self._filename)
+            return None
+        return cached['capabilities']
+
+
+class M2EECircuitBreaker:
+    """
+    Stops sending requests to the admin API of a JVM that does not respond,
+    for example because it's stuck in garbage collection. After a number of
+    consecutive timeouts, all requests fail immediately during the cooldown
+    period. After that, a cheap echo request is used to probe whether the JVM
+    responds again, before letting requests through.
+
+    The state is kept in a file, so all invocations of m2ee for the same
+    application, like the munin and nagios plugins, share it. As with
+    M2EECapabilityCache, the get_key function returns the key for the
+    currently running JVM, or None if there is none.
+    """
+
+    def __init__(self, filename, get_key, timeouts=3, cooldown=30, probe_timeout=5):
+        self._filename = filename
+        self._get_key = get_key
+        self._timeouts = timeouts
+        self._cooldown = cooldown
+        self.probe_timeout = probe_timeout
+
+    def _update(self, change):
+        """
+        Calls change with the current state, while holding an exclusive lock
+        on the state file, and writes the state back if it was changed.
+        """
+        key = self._get_key()
+        if key is None:
+            return None
+        try:
+            fd = os.open(self._filename, os.O_RDWR | os.O_CREAT, 0o600)
+            with os.fdopen(fd, 'r+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    state = json.loads(f.read() or '{}')
+                except ValueError:
+                    state = {}
+                if state.get('key') != key:
+                    state = {'key': key, 'timeouts': 0, 'opened': None}
+                original = dict(state)
+                result = change(state)
+                if state != original:
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(state, f)
+                return result
+        except (IOError, OSError) as e:
+            logger.error("Error using admin circuit breaker state %s: %s" %
+                         (self._filename, e))
+            return None
+
+    def check(self, probe):
+        """
+        Raises M2EEAdminCircuitOpen when no requests should be sent right now.
+        When the cooldown period is over, probe is called to find out whether
+        the JVM responds again.
+        """
+        def change(state):
+            if state['opened'] is None:
+                return False
+            remaining = state['opened'] + self._cooldown - time.time()
+            if remaining > 0:
+                raise M2EEAdminCircuitOpen(
+                    "Admin API did not respond to %s requests in a row, not sending "
+                    "requests for another %d seconds." % (state['timeouts'], remaining + 1))
+            # Let other processes fail fast while we're probing.
+            state['opened'] = time.time()
+            return True
+
+        if not self._update(change):
+            return
+        logger.debug("Checking whether the admin API responds again")
+        try:
+            probe()
+        except M2EEAdminTimeout:
+            self.timeout()
+            raise M2EEAdminCircuitOpen("Admin API still does not respond, not sending "
+                                       "requests for %d seconds." % self._cooldown)
+        except Exception as e:
+            # Any answer means it's not hanging anymore.
+            logger.trace("Admin API probe failed, but did not time out: %s" % e)
+        self.success()
+
+    def timeout(self):
+        def change(state):
+            state['timeouts'] += 1
+            if state['timeouts'] >= self._timeouts:
+                if state['opened'] is None:
+                    logger.warn("Admin API did not respond to %s requests in a row, not "
+                                "sending requests for %d seconds." %
+                                (state['timeouts'], self._cooldown))
+                state['opened'] = time.time()
+        self._update(change)
+
+    def success(self):
+        def change(state):
+            state['timeouts'] = 0
+            state['opened'] = None
+        self._update(change)
+
+
+class M2EERequestCoalescer:
+    """
+    Lets identical requests for read-only actions that are done at the same
+    time share a single request to the admin API. The result is also handed
+    out to callers that show up within a short time (ttl, in seconds, per
+    action) after it was received. Errors are shared with the callers that
+    were already waiting, but are never reused after that.
+    """
+
+    default_ttls = {
+        "about": 5,
+        "runtime_status": 1,
+        "runtime_statistics": 1,
+        "server_statistics": 1,
+        "cache_statistics": 1,
+        "check_health": 1,
+        "get_license_information": 5,
+        "get_all_thread_stack_traces": 1,
+    }
+
+    def __init__(self, ttls=None):
+        self._ttls = ttls if ttls is not None else M2EERequestCoalescer.default_ttls
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def coalesces(self, action):
+        return action in self._ttls
+
+    def request(self, action, params, timeout, send):
+        key = (action, json.dumps(params, sort_keys=True))
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None or (call.done() and call.expires < time.time())
+            if leader:
+                call = M2EEFuture()
+                call.expires = 0
+                self._calls[key] = call
+        if leader:
+            try:
+                feedback = send(action, params, timeout)
+                call.expires = time.time() + self._ttls[action]
+                call.set_result(feedback)
+            except Exception as e:
+                call.set_exception(e)
+        else:
+            logger.trace("Sharing result of %s request" % action)
+        # callers are free to modify what they get
+        return copy.deepcopy(call.result(timeout))
+
+
+class M2EELatencyHistogram:
+    """
+    Counts response times into a fixed set of buckets, so recording is cheap
+    and memory usage does not grow with the amount of requests. Percentiles
+    are reported as the upper bound of the bucket they fall into.
+    """
+
+    # upper bounds of the buckets, in milliseconds
+    bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+    def __init__(self):
+        self.counts = [0] * (len(M2EELatencyHistogram.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, ms):
+        self.counts[bisect.bisect_left(M2EELatencyHistogram.bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, percentage):
+        if self.count == 0:
+            return None
+        rank = self.count * percentage / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                if index < len(M2EELatencyHistogram.bounds):
+                    return min(M2EELatencyHistogram.bounds[index], self.max)
+                break
+        return self.max
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+
+class M2EEActionStatistics:
+
+    def __init__(self):
+        self.latency = M2EELatencyHistogram()
+        self.errors = 0
+        self.timeouts = 0
+        self.last = None
+
+
+class M2EEClientStatistics:
+    """
+    Keeps a latency histogram, and error and timeout counters, per admin
+    action, for all requests sent to the admin API by a client.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._actions = {}
+
+    def record(self, action, seconds, error=False, timeout=False):
+        ms = seconds * 1000
+        with self._lock:
+            stats = self._actions.get(action)
+            if stats is None:
+                stats = self._actions[action] = M2EEActionStatistics()
+            stats.latency.record(ms)
+            stats.last = ms
+            if timeout:
+                stats.timeouts += 1
+            elif error:
+                stats.errors += 1
+
+    def summary(self, reset=False):
+        """
+        Returns the statistics per action. With reset, the statistics start
+        over afterwards, so the next summary only covers the requests that
+        were done in between.
+        """
+        with self._lock:
+            summary = {
+                action: {
+                    "count": stats.latency.count,
+                    "errors": stats.errors,
+                    "timeouts": stats.timeouts,
+                    "mean_ms": stats.latency.mean(),
+                    "p50_ms": stats.latency.percentile(50),
+                    "p90_ms": stats.latency.percentile(90),
+                    "p99_ms": stats.latency.percentile(99),
+                    "max_ms": stats.latency.max,
+                    "last_ms": stats.last,
+                }
+                for action, stats in self._actions.items()
+            }
+            if reset:
+                self._actions = {}
+            return summary
+
+
 class M2EEClient:
 
-    def __init__(self, url, password):
+    def __init__(self, url, password, capability_cache=None, coalesce=False,
+                 transport=None, circuit_breaker=None):
         self._url = url
         self._headers = {
             'Content-Type': 'application/json',
             'X-M2EE-Authentication': b64encode(bytearray(password, 'utf-8')),
-            'Connection': 'close',
         }
+        self._pool = M2EEConnectionPool()
+        self._executor = M2EEExecutor()
+        self._capability_cache = capability_cache
+        self.statistics = M2EEClientStatistics()
+        self._coalescer = None
+        if coalesce is True:
+            self._coalescer = M2EERequestCoalescer()
+        elif coalesce:
+            self._coalescer = M2EERequestCoalescer(coalesce)
+        # Optional object with a send(post, action, params, timeout) method,
+        # that takes care of executing requests instead of doing post
+        # directly, see m2ee.recording.
+        self._transport = transport
+        self._circuit_breaker = circuit_breaker
+
+    def close(self):
+        self._pool.clear()
+        if self._transport is not None:
+            self._transport.close()
 
     def request(self, action, params=None, timeout=None):
+        return self._request(action, params, timeout)
+
+    def _request(self, action, params=None, timeout=None):
+        if self._coalescer is not None and self._coalescer.coalesces(action):
+            return self._coalescer.request(action, params, timeout, self._send)
+        return self._send(action, params, timeout)
+
+    def _send(self, action, params=None, timeout=None):
+        if self._circuit_breaker is not None:
+            self._circuit_breaker.check(self._probe)
+        start = time.time()
+        try:
+            feedback = self._execute(action, params, timeout)
+        except M2EEAdminTimeout:
+            self.statistics.record(action, time.time() - start, timeout=True)
+            self._responded(False)
+            raise
+        except Exception:
+            self.statistics.record(action, time.time() - start, error=True)
+            self._responded(True)
+            raise
+        self.statistics.record(action, time.time() - start)
+        self._responded(True)
+        return feedback
+
+    def _execute(self, action, params=None, timeout=None):
+        if self._transport is not None:
+            return self._transport.send(self._post, action, params, timeout)
+        return self._post(action, params, timeout)
+
+    def _probe(self):
+        self._execute("echo", {"echo": "ping"}, self._circuit_breaker.probe_timeout)
+
+    def _responded(self, responded):
+        if self._circuit_breaker is None:
+            return
+        if responded:
+            self._circuit_breaker.success()
+        else:
+            self._circuit_breaker.timeout()
+
+    def _post(self, action, params=None, timeout=None):
         body = {"action": action}
         if params:
             body["params"] = params
         body = json.dumps(body)
         try:
-            h = httplib2.Http(timeout=timeout, proxy_info=None)  # httplib does not like os.fork
             logger.trace("M2EE request body: %s" % body)
-            response_headers, response_bytes = h.request(self._url, "POST", body,
-                                                         headers=self._headers)
+            h = self._pool.acquire(timeout)
+            reusable = False
+            try:
+                response_headers, response_bytes = h.request(self._url, "POST", body,
+                                                             headers=self._headers)
+                reusable = True
+            finally:
+                self._pool.release(h, timeout, reusable)
             response_body = response_bytes.decode('utf-8')
             logger.trace("M2EE response: %s" % response_body)
             if (response_headers['status'] != "200"):
                 raise M2EEAdminHTTPException("Non OK http status code: %s %s" %
                                              (response_headers, response_body))
             response = json.loads(response_body)
-            result = response['result']
-            if result == M2EEAdminException.ERR_ACTION_NOT_FOUND and action != "runtime_status":
-                status = self.runtime_status()['status']
-                if status != 'running':
-                    raise M2EERuntimeNotFullyRunning(status, action)
-            if result != 0:
-                raise M2EEAdminException(action, response)
+            self._check_result(action, response)
             return response.get('feedback', {})
         except AttributeError as e:
             # httplib 0.6 throws this in case of a connection refused :-|
@@ -67,6 +505,109 @@ class M2EEClient:
             logger.trace(message)
             raise M2EEAdminNotAvailable(message)
 
+    def _check_result(self, action, response):
+        result = response['result']
+        if ((result == M2EEAdminException.ERR_ACTION_NOT_FOUND
+             and action != "runtime_status"
+             and not self._known_unavailable(action))):
+            status = self._request("runtime_status")['status']
+            if status != 'running':
+                raise M2EERuntimeNotFullyRunning(status, action)
+        if result != 0:
+            raise M2EEAdminException(action, response)
+
+    def request_stream(self, action, params=None, timeout=None, path=()):
+        """
+        Like request, but instead of returning the feedback as a whole, the
+        returned M2EEFeedbackStream yields (key, value) for each member of the
+        feedback, or of the object or array found at path inside the
+        feedback, while the response is being received. Use this for actions
+        which can return very large amounts of data.
+        """
+        return M2EEFeedbackStream(self, action, params, timeout, path)
+
+    def _stream(self, action, params, timeout, path, other):
+        if self._transport is not None:
+            # recorded requests are always complete responses
+            for item in self._stream_feedback(action, params, timeout, path, other):
+                yield item
+            return
+        if self._circuit_breaker is not None:
+            self._circuit_breaker.check(self._probe)
+        body = {"action": action}
+        if params:
+            body["params"] = params
+        body = json.dumps(body)
+        url = urlparse(self._url)
+        start = time.time()
+        conn = None
+        try:
+            logger.trace("M2EE streaming request body: %s" % body)
+            conn = httplib.HTTPConnection(url.hostname, url.port, timeout=timeout)
+            conn.request("POST", url.path or '/', body, self._headers)
+            response = conn.getresponse()
+            if response.status != 200:
+                raise M2EEAdminHTTPException("Non OK http status code: %s %s" %
+                                             (response.status, response.read()))
+            reader = JSONStreamReader(response.read)
+            for item in iter_items(reader, ('feedback',) + tuple(path), other):
+                yield item
+            self._check_result(action, other)
+        except socket.timeout:
+            message = "Admin API does not respond. Timeout reached after %s seconds." % timeout
+            logger.trace(message)
+            self.statistics.record(action, time.time() - start, timeout=True)
+            self._responded(False)
+            raise M2EEAdminTimeout(message)
+        except (socket.error, httplib.HTTPException) as e:
+            message = "Admin API not available for requests: (%s: %s)" % (type(e), e)
+            logger.trace(message)
+            self.statistics.record(action, time.time() - start, error=True)
+            self._responded(True)
+            raise M2EEAdminNotAvailable(message)
+        except Exception:
+            self.statistics.record(action, time.time() - start, error=True)
+            self._responded(True)
+            raise
+        finally:
+            if conn is not None:
+                conn.close()
+        self.statistics.record(action, time.time() - start)
+        self._responded(True)
+
+    def _stream_feedback(self, action, params, timeout, path, other):
+        value = self._request(action, params, timeout)
+        other['result'] = 0
+        for key in path:
+            if isinstance(value, dict) and key in value:
+                other.update((k, v) for k, v in value.items() if k != key)
+                value = value[key]
+            elif isinstance(value, list) and isinstance(key, int) and key < len(value):
+                value = value[key]
+            else:
+                value = None
+                break
+        if isinstance(value, dict):
+            items = value.items()
+        elif isinstance(value, list):
+            items = enumerate(value)
+        else:
+            items = []
+        for item in items:
+            yield item
+
+    def batch(self, actions, timeout=None, return_exceptions=True):
+        """
+        Execute a list of (action, params) tuples concurrently, and return a
+        list with the feedback of each action, in the same order. The timeout
+        is a deadline for the batch as a whole. By default, an exception that
+        occurs while executing an action takes the place of its feedback in
+        the result, instead of being raised.
+        """
+        futures = [self._executor.submit(self._request, action, params, timeout)
+                   for action, params in actions]
+        return gather(futures, timeout, return_exceptions)
+
     def ping(self, timeout=5):
         try:
             self.echo(timeout=timeout)
@@ -81,14 +622,48 @@ class M2EEClient:
             myparams.update(params)
         return self.request("echo", myparams, timeout)
 
-    def require_action(self, action):
-        feedback = self.get_admin_action_info()
-        if action not in feedback['action_info']:
+    def require_action(self, action, timeout=10):
+        if action not in self.get_capabilities(timeout)['actions']:
             raise M2EEAdminException(
                 action,
                 {"result": M2EEAdminException.ERR_ACTION_NOT_FOUND}
             )
 
+    def get_capabilities(self, timeout=10):
+        """
+        Returns a dictionary with the list of available admin actions and the
+        about information of the Mendix Runtime. The result is only cached
+        when the runtime is fully running, since more actions become available
+        after starting it. The timeout applies to all requests that are needed
+        to find out together.
+        """
+        capabilities = self.cached_capabilities()
+        if capabilities is not None:
+            return capabilities
+        feedback, about, status = self.batch([
+            ("get_admin_action_info", None),
+            ("about", None),
+            ("runtime_status", None),
+        ], timeout, return_exceptions=False)
+        capabilities = {
+            "actions": sorted(feedback['action_info'].keys()),
+            "about": about,
+        }
+        if self._capability_cache is not None and status['status'] == 'running':
+            self._capability_cache.store(capabilities)
+        return capabilities
+
+    def cached_capabilities(self):
+        if self._capability_cache is None:
+            return None
+        return self._capability_cache.get()
+
+    def _known_unavailable(self, action):
+        # Only a fully running runtime gets its capabilities cached, so it is
+        # not needed to ask for the runtime status to explain a missing action.
+        capabilities = self.cached_capabilities()
+        return capabilities is not None and action not in capabilities['actions']
+
     def get_admin_action_info(self, timeout=None):
         return self.request("get_admin_action_info", timeout=timeout)
 
@@ -179,6 +754,12 @@ class M2EEClient:
     def get_all_thread_stack_traces(self, timeout=None):
         return self.request("get_all_thread_stack_traces", timeout=timeout)
 
+    def iter_all_thread_stack_traces(self, timeout=None):
+        return self.request_stream("get_all_thread_stack_traces", timeout=timeout)
+
+    def count_threads(self, timeout=None):
+        return sum(1 for _ in self.iter_all_thread_stack_traces(timeout=timeout))
+
     def get_license_information(self, timeout=None):
         return self.request("get_license_information", timeout=timeout)
 
@@ -201,6 +782,128 @@ class M2EEClient:
         return self.request("cache_statistics", timeout=timeout)
 
 
+class M2EEFeedbackStream:
+    """
+    Iterable over the members of the feedback of a streaming admin request.
+    All other members of the response that were encountered while iterating
+    (like the result code, or a count next to a list of items) are available
+    in other afterwards.
+    """
+
+    def __init__(self, client, action, params, timeout, path):
+        self.other = {}
+        self._items = client._stream(action, params, timeout, path, self.other)
+
+    def __iter__(self):
+        return self._items
+
+
+class M2EEFuture:
+    """
+    Placeholder for the outcome of an admin request which is executed in the
+    background. Use result() to wait for the feedback, or the exception that
+    was raised while executing the request.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def exception(self, timeout=None):
+        if not self.wait(timeout):
+            raise M2EEAdminTimeout("No result available after waiting %.1f seconds." %
+                                   timeout)
+        return self._exception
+
+    def result(self, timeout=None):
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+
+class M2EEExecutor:
+    """
+    Runs functions in background threads, with at most max_workers of them
+    running at the same time. No threads are kept around when idle, so an
+    executor can be used safely before and after forking.
+    """
+
+    def __init__(self, max_workers=8):
+        self._slots = threading.BoundedSemaphore(max_workers)
+
+    def submit(self, func, *args, **kwargs):
+        future = M2EEFuture()
+        thread = threading.Thread(target=self._run, args=(future, func, args, kwargs))
+        thread.daemon = True
+        thread.start()
+        return future
+
+    def _run(self, future, func, args, kwargs):
+        with self._slots:
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+
+def gather(futures, timeout=None, return_exceptions=False):
+    """
+    Wait for all futures, using one deadline for all of them together, and
+    return their results in the same order. When return_exceptions is True,
+    exceptions are put into the list of results instead of being raised.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    results = []
+    for future in futures:
+        remaining = None if deadline is None else max(0, deadline - time.time())
+        try:
+            results.append(future.result(remaining))
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
+
+
+class AsyncM2EEClient:
+    """
+    Provides all methods of the M2EEClient it wraps, but instead of waiting
+    for the admin API to respond, every call immediately returns an
+    M2EEFuture. Multiple requests can be sent concurrently and be collected
+    using gather(). Connections are taken from the same pool as the one used
+    by the wrapped client.
+    """
+
+    def __init__(self, client, max_workers=8):
+        self._client = client
+        self._executor = M2EEExecutor(max_workers)
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+        if name.startswith('_') or not callable(method):
+            return method
+
+        def submit(*args, **kwargs):
+            return self._executor.submit(method, *args, **kwargs)
+        return submit
+
+
 class M2EEAdminHTTPException(Exception):
     pass
 
@@ -213,6 +916,10 @@ class M2EEAdminTimeout(Exception):
     pass
 
 
+class M2EEAdminCircuitOpen(M2EEAdminTimeout):
+    pass
+
+
 class M2EERuntimeNotFullyRunning(Exception):
     def __init__(self, status, action):
         self.status = status
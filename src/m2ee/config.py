@@ -10,6 +10,7 @@ import os
 import sys
 import pwd
 import copy
+import time
 
 from collections import defaultdict
 from m2ee.version import MXVersion
@@ -20,7 +21,7 @@ logger = logging.getLogger(__name__)
 
 class M2EEConfig:
 
-    def __init__(self, yaml_files=None):
+    def __init__(self, yaml_files=None, read_only=False):
         if yaml_files is None:
             yaml_files = find_yaml_files()
 
@@ -50,7 +51,8 @@ class M2EEConfig:
             self._all_systems_are_go = False
             return
 
-        self.fix_permissions()
+        if not read_only:
+            self.fix_permissions()
 
         self._runtime_path = self.lookup_in_mxjar_repo(str(self.runtime_version))
         if self._runtime_path is None:
@@ -406,6 +408,67 @@ class M2EEConfig:
                                           self.get_default_dotm2ee_directory(),
                                           'm2ee.pid'))
 
+    def get_admin_request_coalescing(self):
+        coalescing = self._conf['m2ee'].get('admin_request_coalescing', False)
+        if not isinstance(coalescing, (bool, dict)):
+            logger.warn("admin_request_coalescing option in m2ee section in "
+                        "configuration is not a boolean or dictionary")
+            return False
+        return coalescing
+
+    def get_admin_recording(self):
+        recording = self._conf['m2ee'].get('admin_recording', None)
+        if recording is None:
+            return None
+        if ((not isinstance(recording, dict)
+             or recording.get('mode', None) not in ('record', 'replay')
+             or 'file' not in recording)):
+            logger.warn("admin_recording option in m2ee section in configuration "
+                        "needs a mode (record or replay) and a file, ignoring it")
+            return None
+        return recording
+
+    def get_admin_circuit_breaker(self):
+        circuit_breaker = self._conf['m2ee'].get('admin_circuit_breaker', False)
+        if circuit_breaker is False or circuit_breaker is None:
+            return None
+        options = {
+            'timeouts': 3,
+            'cooldown': 30,
+            # the .m2ee directory can be shared by multiple applications
+            'file': os.path.join(self.get_default_dotm2ee_directory(),
+                                 'circuit-breaker-%s.json' % self.get_admin_port()),
+        }
+        if isinstance(circuit_breaker, dict):
+            options.update(circuit_breaker)
+        elif circuit_breaker is not True:
+            logger.warn("admin_circuit_breaker option in m2ee section in "
+                        "configuration is not a boolean or dictionary")
+        return options
+
+    def get_snapshot_cache(self):
+        options = {
+            'ttl': 10,
+            # munin config_cache is where munin used to keep the last known
+            # statistics, before they became part of the snapshot cache
+            'file': self._conf['m2ee'].get('munin', {}).get(
+                'config_cache', os.path.join(self.get_default_dotm2ee_directory(),
+                                             'snapshot-cache-%s.json' % self.get_admin_port())),
+        }
+        snapshot_cache = self._conf['m2ee'].get('snapshot_cache', {})
+        if isinstance(snapshot_cache, dict):
+            options.update(snapshot_cache)
+        else:
+            logger.warn("snapshot_cache option in m2ee section in configuration "
+                        "is not a dictionary")
+        return options
+
+    def get_capability_cache(self):
+        return self._conf['m2ee'].get('capability_cache',
+                                      os.path.join(
+                                          self.get_default_dotm2ee_directory(),
+                                          'capability-cache-%s.json' % self.get_admin_port()))
+
     def get_logfile(self):
         return self._conf['m2ee'].get('logfile', None)
 
@@ -424,6 +487,9 @@ class M2EEConfig:
     def get_munin_options(self):
         return self._conf['m2ee'].get('munin', {})
 
+    def get_openmetrics_options(self):
+        return self._conf['m2ee'].get('openmetrics', {})
+
     def allow_destroy_db(self):
         return self._conf['m2ee'].get('allow_destroy_db', True)
 
@@ -500,6 +566,25 @@ class M2EEConfig:
     def get_database_dump_path(self):
         return self._conf['m2ee']['database_dump_path']
 
+    def get_database_dump_name(self, database, directory=False):
+        # dumps in directory format are directories, which get a .d suffix
+        return "%s_%s.backup%s" % (database, time.strftime("%Y%m%d_%H%M%S"),
+                                   ".d" if directory else "")
+
+    def get_database_dump_options(self):
+        options = {
+            'jobs': 1,
+            'compression': None,
+            'compressor': 'none',
+        }
+        database_dump = self._conf['m2ee'].get('database_dump', {})
+        if isinstance(database_dump, dict):
+            options.update(database_dump)
+        else:
+            logger.warn("database_dump option in m2ee section in configuration "
+                        "is not a dictionary")
+        return options
+
     def get_model_upload_path(self):
         return self._conf['m2ee']['model_upload_path']
 
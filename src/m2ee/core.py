@@ -9,8 +9,11 @@ import time
 import copy
 
 from m2ee.config import M2EEConfig
-from m2ee.client import M2EEClient
+from m2ee.client import M2EEClient, M2EECapabilityCache, M2EECircuitBreaker
+from m2ee.recording import M2EERecorder, M2EEReplayer
+from m2ee.pgutil import M2EEPgStatsCollector
 from m2ee.runner import M2EERunner
+from m2ee.snapshot import M2EESnapshotCache
 from m2ee.version import MXVersion
 from m2ee.exceptions import M2EEException
 
@@ -21,8 +24,11 @@ logger = logging.getLogger(__name__)
 
 class M2EE():
 
-    def __init__(self, yaml_files=None):
+    def __init__(self, yaml_files=None, read_only=False):
         self._yaml_files = yaml_files
+        # only look at the application, without changing anything on disk,
+        # e.g. when monitoring it as another user
+        self._read_only = read_only
         self.reload_config()
         self._logproc = None
 
@@ -32,11 +38,55 @@ class M2EE():
             self.reload_config()
 
     def reload_config(self):
-        self.config = M2EEConfig(yaml_files=self._yaml_files)
+        self.config = M2EEConfig(yaml_files=self._yaml_files, read_only=self._read_only)
+        if hasattr(self, 'client'):
+            self.client.close()
+            self.pg_stats.close()
+        transport = self._admin_transport()
+        capability_cache = None
+        if transport is None:
+            # a recording must contain the requests to find out the
+            # capabilities, so it can be replayed on its own
+            capability_cache = M2EECapabilityCache(
+                self.config.get_capability_cache(),
+                self._jvm_key)
+        circuit_breaker = None
+        circuit_breaker_options = self.config.get_admin_circuit_breaker()
+        if circuit_breaker_options is not None:
+            circuit_breaker = M2EECircuitBreaker(
+                circuit_breaker_options['file'],
+                self._jvm_key,
+                timeouts=circuit_breaker_options['timeouts'],
+                cooldown=circuit_breaker_options['cooldown'])
         self.client = M2EEClient(
             'http://127.0.0.1:%s/' % self.config.get_admin_port(),
-            self.config.get_admin_pass())
+            self.config.get_admin_pass(),
+            capability_cache=capability_cache,
+            coalesce=self.config.get_admin_request_coalescing(),
+            transport=transport,
+            circuit_breaker=circuit_breaker)
         self.runner = M2EERunner(self.config, self.client)
+        self.pg_stats = M2EEPgStatsCollector(self.config)
+        snapshot_cache = self.config.get_snapshot_cache()
+        self.snapshot_cache = M2EESnapshotCache(snapshot_cache['file'],
+                                                snapshot_cache['ttl'])
+
+    def _admin_transport(self):
+        recording = self.config.get_admin_recording()
+        if recording is None:
+            return None
+        try:
+            if recording['mode'] == 'record':
+                return M2EERecorder(recording['file'])
+            return M2EEReplayer(recording['file'], recording.get('speed', 1.0))
+        except (IOError, OSError) as e:
+            raise M2EEException("Unable to open admin recording %s" % recording['file'], e)
+
+    def _jvm_key(self):
+        pid = self.runner.get_pid()
+        if pid is None or not self.runner.check_pid(pid):
+            return None
+        return [pid, str(self.config.get_runtime_version())]
 
     def check_alive(self):
         pid_alive = self.runner.check_pid()
@@ -83,8 +133,14 @@ class M2EE():
         self.runner.start(detach=detach, timeout=timeout)
         logger.debug("MxRuntime status: %s" % self.client.runtime_status()['status'])
 
-        # go do startup sequence
-        self._configure_logging()
+        # go do startup sequence, starting with logging, so no log lines of
+        # applying the configuration get lost. The log subscribers are created
+        # at the same time, and then all their log levels are set at once.
+        log_subscribers, log_levels = self._logging_actions()
+        self.client.batch(log_subscribers, return_exceptions=False)
+        self.client.batch(log_levels, return_exceptions=False)
+        self.client.start_logging()
+
         self._send_mime_types()
 
         if version < 5:
@@ -151,21 +207,25 @@ class M2EE():
             self.runner.cleanup_pid()
         return True
 
-    def _configure_logging(self):
+    def _logging_actions(self):
+        # Log levels can only be set after the log subscriber exists, so they
+        # are returned separately.
         logger.debug("Setting up logging...")
         version = self.config.get_runtime_version()
         logging_config = self.config.get_logging_config()
+        log_subscribers = []
+        log_levels = []
         for log_subscriber in logging_config:
             loglevels = log_subscriber.pop('loglevel', None)
-            self.client.create_log_subscriber(log_subscriber)
+            log_subscribers.append(("create_log_subscriber", log_subscriber))
             if version >= 6 and loglevels is not None:
-                self.client.set_log_level({
+                log_levels.append(("set_log_level", {
                     "subscriber": log_subscriber['name'],
                     "nodes": [{'name': name, 'level': level}
                               for name, level in loglevels.items()],
                     "force": True,
-                })
-        self.client.start_logging()
+                }))
+        return log_subscribers, log_levels
 
     def _send_jetty_config(self):
         jetty_opts = self.config.get_jetty_options()
@@ -0,0 +1,117 @@
+#
+# Copyright (C) 2009 Mendix. All rights reserved.
+#
+
+import codecs
+import json
+
+WHITESPACE = u' \t\r\n'
+
+
+class JSONStreamReader:
+    """
+    Reads a JSON document from a file-like read function while it's being
+    received, only keeping the part of the text in memory that has not been
+    parsed yet.
+    """
+
+    def __init__(self, read, chunk_size=65536):
+        self._read = read
+        self._chunk_size = chunk_size
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buffer = u''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            return False
+        unparsed = self._buffer[self._pos:]
+        # read at least as much as we already have, so values that span a lot
+        # of chunks do not have to be parsed over and over again
+        data = self._read(max(self._chunk_size, len(unparsed)))
+        if not data:
+            self._eof = True
+        self._buffer = unparsed + self._decoder.decode(data, final=self._eof)
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """
+        Returns the next character that is not whitespace, without consuming
+        it.
+        """
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON document")
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError("Expected one of '%s' in JSON document, but found '%s'" %
+                             (chars, char))
+        self._pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buffer, self._pos)
+                # a number at the end of the buffer might continue in the
+                # next chunk
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            self._fill()
+
+
+def iter_keys(reader):
+    """
+    Walks over an object or array, yielding the key or index of each member.
+    After every key, the caller must consume the value from the reader,
+    before continuing the iteration.
+    """
+    opening = reader.expect('{[')
+    closing = '}' if opening == '{' else ']'
+    if reader.peek() == closing:
+        reader.expect(closing)
+        return
+    index = 0
+    while True:
+        if opening == '{':
+            key = reader.value()
+            reader.expect(':')
+        else:
+            key = index
+            index += 1
+        yield key
+        if reader.expect(',' + closing) == closing:
+            return
+
+
+def iter_items(reader, path=(), other=None):
+    """
+    Yields (key, value) for every member of the object or array that is found
+    by following path (a sequence of keys) into the document, without
+    building the complete document in memory. Other members that are
+    encountered on the way are put into the other dictionary, if provided.
+    """
+    for key in iter_keys(reader):
+        if not path:
+            yield key, reader.value()
+        elif key == path[0] and reader.peek() in '{[':
+            for item in iter_items(reader, path[1:], other):
+                yield item
+        else:
+            value = reader.value()
+            if other is not None:
+                other[key] = value
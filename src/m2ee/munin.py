@@ -3,13 +3,20 @@
 #
 
 from __future__ import print_function
+import glob
 import json
 import logging
 import os
+import pwd
+import re
+import sys
+import time
 from m2ee.client import M2EEAdminException, M2EEAdminNotAvailable, \
-    M2EEAdminHTTPException, M2EEAdminTimeout
+    M2EEAdminHTTPException, M2EEAdminTimeout, AsyncM2EEClient, M2EEExecutor, gather
+from m2ee.core import M2EE
 import m2ee.smaps as smaps
-import m2ee.pgutil
+import m2ee.threads as threads
+from m2ee import util
 
 logger = logging.getLogger(__name__)
 
@@ -76,51 +83,199 @@ default_stats = {
 }
 
 
-def print_config(m2, name):
-    stats, java_version = get_stats('config', m2)
-    if stats is not None:
-        options = m2.config.get_munin_options()
-        print_requests_config(name, stats)
-        print_connectionbus_config(name, m2, stats)
-        print_sessions_config(name, stats, options.get('graph_total_named_users', True))
-        print_jvmheap_config(name, stats)
-        print_threadpool_config(name, stats)
-        print_cache_config(name, stats)
-        print_jvm_threads_config(name, stats)
-        print_jvm_process_memory_config(name)
-    if m2.config.is_using_postgresql():
-        print_pg_stat_database_config(name)
-        print_pg_stat_activity_config(name)
-        print_pg_table_index_size_config(name)
+def print_config(m2, name, stats=None):
+    sys.stdout.write(config_text(m2, name, stats))
+
+
+def print_values(m2, name, values=None):
+    sys.stdout.write(values_text(m2, name, values))
+
 
+def print_config_and_values(m2, name):
+    """
+    Prints the config followed by the values, based on a single retrieval of
+    the statistics, for munin-node versions that support the dirtyconfig
+    capability. Munin then doesn't need to run the plugin again to fetch the
+    values.
+    """
+    sys.stdout.write(config_and_values_text(m2, name))
 
-def print_values(m2, name):
-    stats, java_version = get_stats('values', m2)
+
+def config_text(m2, name, stats=None):
+    if stats is None:
+        timeout = m2.config.get_munin_options().get('timeout', 5)
+        stats, _ = get_stats('config', m2, timeout)
+    return get_config_text(m2, name, get_config_shape(m2, stats))
+
+
+def values_text(m2, name, values=None):
+    if values is None:
+        values = get_values(m2)
+    stats = values['stats']
+    options = m2.config.get_munin_options()
+    lines = []
     if stats is not None:
-        options = m2.config.get_munin_options()
-        print_requests_values(name, stats)
-        print_connectionbus_values(name, stats)
-        print_sessions_values(name, stats, options.get('graph_total_named_users', True))
-        print_jvmheap_values(name, stats)
-        print_threadpool_values(name, stats)
-        print_cache_values(name, stats)
-        print_jvm_threads_values(name, stats)
-        print_jvm_process_memory_values(name, stats, m2.runner.get_pid(), java_version)
-    if m2.config.is_using_postgresql():
-        print_pg_stat_database_values(name, m2)
-        print_pg_stat_activity_values(name, m2)
-        print_pg_table_index_size_values(name, m2)
+        lines.extend(requests_values(name, stats))
+        lines.extend(connectionbus_values(name, stats))
+        lines.extend(sessions_values(name, stats,
+                                     options.get('graph_total_named_users', True)))
+        lines.extend(jvmheap_values(name, stats))
+        lines.extend(threadpool_values(name, stats))
+        lines.extend(cache_values(name, stats))
+        lines.extend(jvm_threads_values(name, stats))
+        lines.extend(jvm_process_memory_values(name, stats, values['smaps'],
+                                               values['java_version']))
+    if values.get('pg_stat_database') is not None:
+        lines.extend(pg_stat_database_values(name, values['pg_stat_database']))
+    if values.get('pg_stat_activity') is not None:
+        lines.extend(pg_stat_activity_values(name, values['pg_stat_activity'],
+                                             values['max_active_db_connections']))
+    if values.get('pg_table_index_size') is not None:
+        lines.extend(pg_table_index_size_values(name, values['pg_table_index_size']))
+    if options.get('graph_admin_latency', False):
+        lines.extend(admin_latency_values(name, values['admin_latency'],
+                                          values['admin_failed']))
+    return _text(lines)
+
+
+def config_and_values_text(m2, name):
+    values = get_values(m2)
+    return config_text(m2, name, values['config_stats']) + values_text(m2, name, values)
+
+
+def print_host(command, yaml_patterns, max_workers=8):
+    """
+    Prints the config, values or both (for dirtyconfig) of all applications
+    on this host in one go, instead of having a plugin run for each of them.
+    The applications are found by expanding yaml_patterns, which are paths to
+    their configuration files, that may contain wildcards. Statistics are
+    collected for at most max_workers applications at the same time.
+    """
+    function = {
+        'config': config_text,
+        'values': values_text,
+        'dirtyconfig': config_and_values_text,
+    }[command]
+    apps = get_host_apps(yaml_patterns)
+    executor = M2EEExecutor(max_workers)
+    futures = [executor.submit(_host_app_text, function, yaml_file, name)
+               for name, yaml_file in apps]
+    # every application is bound by its own munin timeout already
+    for (name, yaml_file), text in zip(apps, gather(futures, return_exceptions=True)):
+        if isinstance(text, Exception):
+            logger.error("Unable to collect munin statistics for %s (%s): %s" %
+                         (name, yaml_file, text))
+            continue
+        sys.stdout.write(text)
+
+
+def get_host_apps(yaml_patterns):
+    """
+    Returns a list of (name, yaml file) for all configuration files matching
+    yaml_patterns. Like for the plugin that runs as the application user, the
+    owner of the configuration file is used as name in the graphs, unless it
+    owns more than one of them.
+    """
+    yaml_files = sorted(set(
+        yaml_file for pattern in yaml_patterns for yaml_file in glob.glob(pattern)))
+    owners = {}
+    for yaml_file in yaml_files:
+        owners.setdefault(_file_owner(yaml_file), []).append(yaml_file)
+    apps = []
+    for owner, owned in sorted(owners.items()):
+        if len(owned) == 1:
+            apps.append((owner, owned[0]))
+            continue
+        for yaml_file in owned:
+            base = os.path.splitext(os.path.basename(yaml_file))[0]
+            if base == 'm2ee':
+                base = os.path.basename(os.path.dirname(os.path.abspath(yaml_file)))
+            apps.append(("%s_%s" % (owner, re.sub('[^A-Za-z0-9_]', '_', base)), yaml_file))
+    return apps
+
+
+def _file_owner(filename):
+    uid = os.stat(filename).st_uid
+    try:
+        return pwd.getpwuid(uid)[0]
+    except KeyError:
+        return str(uid)
 
 
-def guess_java_version(m2, runtime_version, stats):
-    about = m2.client.about(timeout=5)
+def _host_app_text(function, yaml_file, name):
+    m2 = M2EE(yaml_files=[yaml_file], read_only=True)
+    try:
+        return function(m2, name)
+    finally:
+        m2.client.close()
+        m2.pg_stats.close()
+
+
+def dirtyconfig_supported():
+    # munin-node tells plugins about it in the environment
+    return os.environ.get('MUNIN_CAP_DIRTYCONFIG') == '1'
+
+
+def get_values(m2):
+    """
+    Collects everything that is shown in the graphs: the statistics of the
+    runtime, the memory usage of the JVM process and database statistics.
+    The result can be passed to print_values, or be used by other monitoring
+    tools. Information that is not available is None, except for
+    config_stats, which can be passed to print_config.
+    """
+    timeout = m2.config.get_munin_options().get('timeout', 5)
+    deadline = time.time() + timeout
+    pg_stats = None
+    if m2.config.is_using_postgresql():
+        # start the database queries first, they run while we're waiting for
+        # the statistics of the runtime
+        pg_stats = get_pg_stats(m2, timeout)
+    snapshot = _get_stats_snapshot_or_none(m2, timeout)
+    if snapshot is None:
+        config_stats, stats, java_version = (
+            get_last_known_good_or_fake_stats(m2.snapshot_cache), None, None)
+    else:
+        config_stats, stats, java_version = (
+            snapshot['config'], snapshot['stats'], snapshot['java_version'])
+    values = {
+        'config_stats': config_stats,
+        'stats': stats,
+        'java_version': java_version,
+        'smaps': None,
+    }
+    pid = m2.runner.get_pid()
+    if stats is not None and pid is not None:
+        values['smaps'] = smaps.get_smaps_rss_by_category(pid)
+    if pg_stats is not None:
+        pg_stats = gather([pg_stats], max(0, deadline - time.time()),
+                          return_exceptions=True)[0]
+        if isinstance(pg_stats, Exception):
+            logger.error(pg_stats)
+            pg_stats = {}
+        for name in ('pg_stat_database', 'pg_stat_activity', 'pg_table_index_size'):
+            values[name] = pg_stats.get(name)
+        values['max_active_db_connections'] = m2.config.get_max_active_db_connections()
+    # the admin requests that were done to retrieve these statistics, which
+    # might have been done by another process
+    values['admin_latency'] = None if snapshot is None else snapshot.get('admin_latency')
+    values['admin_failed'] = None if snapshot is None else snapshot.get('admin_failed')
+    return values
+
+
+def get_spool_dir(m2):
+    return m2.config.get_munin_options().get(
+        'spool', os.path.join(m2.config.get_default_dotm2ee_directory(), 'munin-spool'))
+
+
+def guess_java_version(about, runtime_version, stats):
     if 'java_version' in about:
         java_version = about['java_version']
         java_major, java_minor, _ = java_version.split('.')
         return int(java_minor)
     if runtime_version // 6:
         return 8
-    if runtime_version // 5:
+    if runtime_version // 5 and 'memory' in stats:
         m = stats['memory']
         if m['used_nonheap'] - m['code'] - m['permanent'] == 0:
             return 7
@@ -128,70 +283,182 @@ def guess_java_version(m2, runtime_version, stats):
     return None
 
 
-def get_stats(action, m2):
-    # place to store last known good statistics result to be used for munin
-    # config when the app is down or b0rked
-    options = m2.config.get_munin_options()
-    config_cache = options.get('config_cache',
-                               os.path.join(m2.config.get_default_dotm2ee_directory(),
-                                            'munin-cache.json'))
-    stats = None
-    java_version = None
+def get_stats(action, m2, timeout=5):
+    config_stats, stats, java_version = get_config_and_values_stats(m2, timeout)
+    if action == 'config':
+        return config_stats, java_version
+    return stats, java_version
+
+
+def get_config_and_values_stats(m2, timeout=5):
+    """
+    Returns the statistics to use for the munin config, the statistics to use
+    for the values and the java version. When the application is not
+    available, the statistics for the values are None, and the last known
+    statistics are used for the config.
+    """
+    snapshot = _get_stats_snapshot_or_none(m2, timeout)
+    if snapshot is None:
+        return get_last_known_good_or_fake_stats(m2.snapshot_cache), None, None
+    return snapshot['config'], snapshot['stats'], snapshot['java_version']
+
+
+def _get_stats_snapshot_or_none(m2, timeout):
     try:
-        stats, java_version = get_stats_from_runtime(m2)
-        write_last_known_good_stats_cache(stats, config_cache)
+        return get_stats_snapshot(m2, timeout)
     except (M2EEAdminException, M2EEAdminNotAvailable,
             M2EEAdminHTTPException, M2EEAdminTimeout) as e:
         if not isinstance(e, M2EEAdminNotAvailable) or m2.runner.check_pid():
             logger.error(e)
-        if action == 'config':
-            return get_last_known_good_or_fake_stats(config_cache), java_version
-    return stats, java_version
-
-
-def get_last_known_good_or_fake_stats(config_cache):
-    stats = read_stats_from_last_known_good_stats_cache(config_cache)
-    if stats is not None:
+        return None
+
+
+def get_stats_snapshot(m2, timeout=5):
+    """
+    Returns the statistics of the application, sharing them with all other
+    m2ee processes that need them for a short while, see M2EESnapshotCache.
+    Besides the statistics that could be retrieved, the result contains the
+    statistics for the munin config, for which missing parts are filled in
+    from the last known ones, to keep the config of all graphs when the
+    application only responds partially. Returns None when another process
+    is busy retrieving them for too long, and there are no earlier ones.
+    """
+    def fetch(time_left):
+        stats, java_version = get_stats_from_runtime(m2, time_left)
+        config = get_config_stats(stats)
+        # requests and threadpool come from runtime_statistics and
+        # server_statistics respectively
+        if 'requests' not in stats or 'threadpool' not in stats:
+            config = dict(get_last_known_good_or_fake_stats(m2.snapshot_cache))
+            config.update(get_config_stats(stats))
+        # Only the requests done for this snapshot, so a long running process
+        # does not show the slowest request since it started. The amount of
+        # failed requests is kept as a counter across snapshots.
+        admin_latency = m2.client.statistics.summary(reset=True)
+        previous = m2.snapshot_cache.last('statistics') or {}
+        admin_failed = previous.get('admin_failed', 0) + sum(
+            action['errors'] + action['timeouts'] for action in admin_latency.values())
+        return {'stats': stats, 'config': config, 'java_version': java_version,
+                'admin_latency': admin_latency, 'admin_failed': admin_failed}
+
+    def compact(snapshot):
+        # The list of sessions grows with the amount of users, and is not
+        # used for any graph, so don't store it over and over again.
+        if 'user_sessions' not in snapshot['stats'].get('sessions', {}):
+            return snapshot
+        stats = dict(snapshot['stats'])
+        stats['sessions'] = dict(stats['sessions'])
+        del stats['sessions']['user_sessions']
+        return dict(snapshot, stats=stats)
+
+    return m2.snapshot_cache.get('statistics', fetch, timeout=timeout, compact=compact)
+
+
+def get_config_stats(stats):
+    """
+    Returns a stripped down version of stats that only contains what the
+    munin config depends on (see get_config_shape), which is stored as last
+    known statistics. Its size doesn't depend on the amount of users, objects
+    etc. in the application.
+    """
+    config = dict((key, {}) for key in (
+        'connectionbus', 'sessions', 'memory', 'threadpool', 'cache', 'thread_states')
+        if key in stats)
+    if 'requests' in stats:
+        config['requests'] = dict((handler, 0) for handler in stats['requests'])
+    if 'threads' in stats:
+        config['threads'] = 0
+    return config
+
+
+def get_last_known_good_or_fake_stats(snapshot_cache):
+    # the last snapshot is kept after it expires, to be used for munin config
+    # when the app is down or b0rked
+    snapshot = snapshot_cache.last('statistics')
+    if snapshot is not None:
         logger.debug("Reusing last known statistics.")
-    else:
-        logger.debug("No last known good statistics found, using fake statistics.")
-        stats = default_stats
-    return stats
+        return snapshot['config']
+    logger.debug("No last known good statistics found, using fake statistics.")
+    return default_stats
+
+
+def get_stats_from_runtime(m2, timeout=5):
+    """
+    Requests all statistics from the runtime concurrently, waiting at most
+    timeout seconds in total. Statistics that are not available in time are
+    left out, so only the graphs that need them go missing. When nothing at
+    all could be retrieved, the first error is raised.
+    """
+    runtime_version = m2.config.get_runtime_version()
+    async_client = AsyncM2EEClient(m2.client)
+    capabilities = m2.client.cached_capabilities()
+    names = ["capabilities", "runtime_statistics", "server_statistics"]
+    futures = [
+        async_client.get_capabilities(timeout=timeout),
+        async_client.runtime_statistics(timeout=timeout),
+        async_client.server_statistics(timeout=timeout),
+    ]
+    pid = m2.runner.get_pid()
+    thread_states = None if pid is None else threads.get_thread_states(pid)
+    # the states in /proc include all threads already, so only count the
+    # stack traces when they are not available, to keep the totals the same
+    if ((thread_states is None
+         and m2.config.get_munin_options().get('thread_stack_traces', False)
+         and (capabilities is None
+              or "get_all_thread_stack_traces" in capabilities['actions']))):
+        # only the number of threads is needed, so count them while the
+        # stack traces are coming in instead of decoding them all at once
+        names.append("threads")
+        futures.append(async_client.count_threads(timeout=timeout))
 
+    logger.debug("trying to fetch runtime/server statistics")
+    feedback = dict(zip(names, gather(futures, timeout, return_exceptions=True)))
+    failed = [(name, e) for name, e in feedback.items() if isinstance(e, Exception)]
+    if len(failed) == len(feedback):
+        raise failed[0][1]
+    for name, e in failed:
+        logger.warn("Leaving out %s: %s" % (name, e))
+        del feedback[name]
 
-def get_stats_from_runtime(m2):
     stats = {}
-    logger.debug("trying to fetch runtime/server statistics")
-    stats.update(m2.client.runtime_statistics(timeout=5))
-    stats.update(m2.client.server_statistics(timeout=5))
-    if type(stats['requests']) == list:
+    stats.update(feedback.get('runtime_statistics', {}))
+    stats.update(feedback.get('server_statistics', {}))
+    if type(stats.get('requests')) == list:
         # convert back to normal, whraagh
         bork = {}
         for x in stats['requests']:
             bork[x['name']] = x['value']
         stats['requests'] = bork
 
-    runtime_version = m2.config.get_runtime_version()
-    if runtime_version is not None and runtime_version >= 3.2:
-        stats['threads'] = len(m2.client.get_all_thread_stack_traces(timeout=5))
+    if thread_states is not None:
+        stats['thread_states'] = thread_states
+        stats['threads'] = sum(thread_states.values())
+    elif 'threads' in feedback:
+        stats['threads'] = feedback['threads']
 
-    java_version = guess_java_version(m2, runtime_version, stats)
-    if 'memorypools' in stats['memory']:
-        memorypools = stats['memory']['memorypools']
+    about = feedback['capabilities']['about'] if 'capabilities' in feedback else {}
+    java_version = guess_java_version(about, runtime_version, stats)
+    if 'memory' in stats:
+        normalize_memory_pools(stats['memory'], java_version)
+    return stats, java_version
+
+
+def normalize_memory_pools(memory, java_version):
+    if 'memorypools' in memory:
+        memorypools = memory['memorypools']
         if java_version == 7:
-            stats['memory']['code'] = memorypools[0]['usage']
-            stats['memory']['permanent'] = memorypools[4]['usage']
-            stats['memory']['eden'] = memorypools[1]['usage']
-            stats['memory']['survivor'] = memorypools[2]['usage']
-            stats['memory']['tenured'] = memorypools[3]['usage']
+            memory['code'] = memorypools[0]['usage']
+            memory['permanent'] = memorypools[4]['usage']
+            memory['eden'] = memorypools[1]['usage']
+            memory['survivor'] = memorypools[2]['usage']
+            memory['tenured'] = memorypools[3]['usage']
         else:
-            stats['memory']['code'] = memorypools[0]['usage']
-            stats['memory']['permanent'] = memorypools[2]['usage']
-            stats['memory']['eden'] = memorypools[3]['usage']
-            stats['memory']['survivor'] = memorypools[4]['usage']
-            stats['memory']['tenured'] = memorypools[5]['usage']
+            memory['code'] = memorypools[0]['usage']
+            memory['permanent'] = memorypools[2]['usage']
+            memory['eden'] = memorypools[3]['usage']
+            memory['survivor'] = memorypools[4]['usage']
+            memory['tenured'] = memorypools[5]['usage']
     elif java_version >= 8:
-        memory = stats['memory']
         metaspace = memory['eden']
         eden = memory['tenured']
         survivor = memory['permanent']
@@ -200,190 +467,368 @@ def get_stats_from_runtime(m2):
         memory['eden'] = eden
         memory['survivor'] = survivor
         memory['tenured'] = old
-    return stats, java_version
 
 
-def write_last_known_good_stats_cache(stats, config_cache):
-    logger.debug("Writing munin cache to %s" % config_cache)
-    try:
-        with open(config_cache, 'w+') as f:
-            f.write(json.dumps(stats))
-    except Exception as e:
-        logger.error("Error writing munin config cache to %s: %s",
-                     (config_cache, e))
+def _field(field, label, draw, info, when=None, extra=()):
+    return (when, field, [('label', label), ('draw', draw), ('info', info)] + list(extra))
+
+
+def _request_fields(shape):
+    fields = []
+    for sub in shape['requests']:
+        subname = sub if sub != '' else '/'
+        fields.append(_field(
+            '_' + sub.strip('/').replace('-', '_'), subname, 'LINE1',
+            "amount of requests this MxRuntime handles on %s" % subname,
+            extra=[('type', 'DERIVE'), ('min', 0)]))
+    return fields
+
+
+CONFIG_TEXT_VERSION = 2
+
+# admin actions that are used while gathering statistics for munin
+admin_latency_actions = (
+    "get_admin_action_info",
+    "about",
+    "runtime_status",
+    "runtime_statistics",
+    "server_statistics",
+    "get_all_thread_stack_traces",
+)
+
+# The graphs of the munin config. A graph is only shown when the part of the
+# shape of the statistics named by 'when' is true, and the same goes for a
+# field. The title can refer to parts of the shape, fields can also be a
+# function of the shape. See get_config_shape.
+graphs = [
+    {
+        'graph': 'mxruntime_requests',
+        'when': 'requests',
+        'args': '--base 1000 -l 0',
+        'vlabel': 'Requests per second',
+        'title': 'MxRuntime Requests',
+        'info': 'This graph shows the amount of requests this MxRuntime handles',
+        'fields': _request_fields,
+    },
+    {
+        'graph': 'mxruntime_connectionbus',
+        'when': 'connectionbus',
+        'args': '--base 1000 -l 0',
+        'vlabel': 'Statements per second',
+        'title': '%(database)s queries',
+        'info': 'This graph shows the amount of executed queries by type',
+        'fields': [
+            _field(s, '%ss' % s, 'LINE1', 'amount of %ss' % s,
+                   extra=[('type', 'DERIVE'), ('min', 0)])
+            for s in ('select', 'insert', 'update', 'delete')
+        ],
+    },
+    {
+        'graph': 'mxruntime_sessions',
+        'when': 'sessions',
+        'args': '--base 1000 -l 0',
+        'vlabel': 'Concurrent user sessions',
+        'title': 'MxRuntime Users',
+        'info': 'This graph shows the amount of user accounts and sessions',
+        'fields': [
+            _field('named_users', 'named users', 'LINE1',
+                   'total amount of named users in the application',
+                   when='graph_total_named_users'),
+            _field('named_user_sessions', 'concurrent named user sessions', 'LINE1',
+                   'amount of concurrent named user sessions'),
+            _field('anonymous_sessions', 'concurrent anonymous user sessions', 'LINE1',
+                   'amount of concurrent anonymous user sessions'),
+        ],
+    },
+    {
+        'graph': 'mxruntime_jvmheap',
+        'when': 'memory',
+        'args': '--base 1024 -l 0',
+        'vlabel': 'Bytes',
+        'title': 'JVM Heap Memory Usage',
+        'info': 'This graph shows memory pool information on the Java JVM',
+        'fields': [
+            _field('tenured', 'tenured generation', 'AREA',
+                   'Old generation of the heap that holds long living objects',
+                   extra=[('colour', 'COLOUR2')]),
+            _field('survivor', 'survivor space', 'STACK',
+                   'Survivor Space of the Young Generation',
+                   extra=[('colour', 'COLOUR3')]),
+            _field('eden', 'eden space', 'STACK', 'Objects are created in Eden',
+                   extra=[('colour', 'COLOUR4')]),
+            _field('free', 'unused', 'STACK', 'Unused memory reserved for use by the JVM heap',
+                   extra=[('colour', 'COLOUR5')]),
+            _field('limit', 'heap size limit', 'LINE1', 'Java Heap memory usage limit',
+                   extra=[('colour', 'COLOUR6')]),
+        ],
+    },
+    {
+        'graph': 'm2eeserver_threadpool',
+        'when': 'threadpool',
+        'args': '--base 1000 -l 0',
+        'vlabel': 'Jetty Threadpool',
+        'title': 'Jetty Threadpool',
+        'info': 'This graph shows threadpool usage information on Jetty',
+        'fields': [
+            _field('min_threads', 'min threads', 'LINE1', 'Minimum number of threads'),
+            _field('max_threads', 'max threads', 'LINE1', 'Maximum number of threads'),
+            _field('active_threads', 'active threads', 'LINE1', 'Active thread count'),
+            _field('threadpool_size', 'threadpool size', 'LINE1', 'Current threadpool size'),
+        ],
+    },
+    {
+        'graph': 'mxruntime_cache',
+        'when': 'cache',
+        'args': '--base 1000 -l 0',
+        'vlabel': 'objects',
+        'title': 'Object Cache',
+        'info': 'This graph shows the total amount of objects in the runtime object cache',
+        'fields': [
+            _field('total', 'Objects in cache', 'LINE1', 'Total amount of objects'),
+        ],
+    },
+    {
+        'graph': 'mxruntime_threads',
+        'when': 'threads',
+        'args': '--base 1000 -l 0',
+        'vlabel': 'threads',
+        'title': 'JVM Threads',
+        'info': 'This graph shows the total amount of threads in the JVM process',
+        'fields': [
+            _field('running', 'running', 'AREA',
+                   'Threads that are running or waiting to be run', when='thread_states'),
+            _field('sleeping', 'sleeping', 'STACK',
+                   'Threads that are waiting for something, e.g. a lock or network',
+                   when='thread_states'),
+            _field('disk_wait', 'disk wait', 'STACK', 'Threads that are waiting for disk I/O',
+                   when='thread_states'),
+            _field('other', 'other', 'STACK', 'Threads in any other state, e.g. stopped',
+                   when='thread_states'),
+            ('thread_states', 'total', [('colour', '000000')]),
+            _field('total', 'threads', 'LINE1', 'Total amount of threads in the JVM process'),
+        ],
+    },
+    {
+        'graph': 'mxruntime_jvm_process_memory',
+        'when': 'smaps',
+        'args': '--base 1024 -l 0',
+        'vlabel': 'Bytes',
+        'title': 'JVM Process Memory Usage',
+        'info': 'This graph shows the total memory usage of the Java JVM process',
+        'fields': [
+            _field('nativecode', 'native code', 'AREA',
+                   'Native program code, e.g. the java binary itself'),
+            _field('jar', 'jar files', 'STACK', 'JAR file contents loaded into memory'),
+            _field('tenured', 'tenured generation', 'STACK',
+                   'Old generation of the Java Heap that holds long living objects'),
+            _field('survivor', 'survivor space', 'STACK',
+                   'Survivor Space of the Young Generation, Java Heap'),
+            _field('eden', 'eden space', 'STACK', 'Objects are created in Eden, Java Heap'),
+            _field('javaheap', 'unused java heap', 'STACK', 'Unused Java Heap'),
+            _field('permanent', 'permanent generation', 'STACK',
+                   'Non-heap memory used to store bytecode versions of classes'),
+            _field('codecache', 'code cache', 'STACK',
+                   'Non-heap memory used for compilation and storage of native code'),
+            _field('nativemem', 'native memory', 'STACK', 'Native heap and memory arenas'),
+            _field('stacks', 'thread stacks', 'STACK', 'Thread stacks'),
+            _field('other', 'other', 'STACK', 'Other, unknown, undetermined memory usage'),
+            _field('total', 'total', 'LINE1', 'Total memory usage'),
+        ],
+    },
+    {
+        'graph': 'mxruntime_pg_stat_tuples',
+        'when': 'postgresql',
+        'args': '-l 0',
+        'vlabel': 'tuple mutations per second',
+        'title': 'PostgreSQL tuple mutations',
+        'info': 'This graph shows amount of tuple mutations',
+        'fields': [
+            _field('tup_%s' % s, 'tuples %s' % s, 'LINE1', 'Number of %s' % info,
+                   extra=[('min', 0), ('type', 'DERIVE')])
+            for s, info in (('inserted', 'inserts'), ('updated', 'updates'),
+                            ('deleted', 'deletes'))
+        ],
+    },
+    {
+        'graph': 'mxruntime_pg_stat_activity',
+        'when': 'postgresql',
+        'args': '-l 0',
+        'vlabel': 'connections',
+        'title': 'PostgreSQL connections',
+        'info': 'This graph shows the amount of open database connections',
+        'fields': [
+            _field('active', 'active', 'AREA',
+                   'Amount of connections that currently execute a query '
+                   '(including this monitoring plugin)'),
+            _field('idle_in_transaction', 'idle in transaction', 'STACK',
+                   'Amount of idle transactions (e.g. running Mendix microflow '
+                   'which is not executing a database operation right now.'),
+            _field('idle_in_transaction_aborted', 'idle in transaction (aborted)', 'STACK',
+                   'Amount of idle transactions with errors'),
+            _field('idle', 'idle', 'STACK', 'Amount of idle (unused) but open connections'),
+            _field('total', 'total', 'LINE1',
+                   'Total amount of open connections as seen by PostgreSQL (e.g. also '
+                   'including this monitoring query and things like backup dump operations)',
+                   extra=[('colour', '000000')]),
+            _field('limit', 'mendix runtime limit', 'LINE1',
+                   'Limit on amount of open connections for the '
+                   'Mendix Runtime connection pooling'),
+        ],
+    },
+    {
+        'graph': 'mxruntime_pg_table_index_size',
+        'when': 'postgresql',
+        'args': '--base 1024 --lower-limit 0',
+        'vlabel': 'bytes',
+        'title': 'PostgreSQL database size',
+        'info': 'This graph shows the distribution of table and index size in a database',
+        'fields': [
+            _field('tables', 'tables', 'AREA', 'Total disk space occupied by tables'),
+            _field('indexes', 'indexes', 'STACK', 'Total disk space occupied by indexes'),
+            _field('total', 'total size', 'LINE0', 'Total database size',
+                   extra=[('colour', '000000')]),
+        ],
+    },
+    {
+        'graph': 'mxruntime_admin_latency',
+        'when': 'graph_admin_latency',
+        'args': '--base 1000 -l 0',
+        'vlabel': 'seconds',
+        'title': 'Admin API response time',
+        'info': 'This graph shows how long the Mendix Runtime took to respond '
+                'to the admin requests done by this plugin',
+        'fields': [
+            _field(action, action, 'LINE1', 'Response time of the %s action' % action)
+            for action in admin_latency_actions
+        ] + [
+            _field('failed', 'failed requests', 'LINE1',
+                   'Amount of admin requests that failed or timed out per second',
+                   extra=[('type', 'DERIVE'), ('min', 0)]),
+        ],
+    },
+]
 
 
-def read_stats_from_last_known_good_stats_cache(config_cache):
-    stats = None
-    logger.debug("Loading munin cache from %s" % config_cache)
+def get_config_shape(m2, stats):
+    """
+    Returns everything the munin config depends on: which statistics are
+    available, the request handlers and the options.
+    """
+    options = m2.config.get_munin_options()
+    postgresql = m2.config.is_using_postgresql()
+    shape = dict((key, key in stats) for key in (
+        'connectionbus', 'sessions', 'memory', 'threadpool', 'cache', 'threads',
+        'thread_states'))
+    shape.update({
+        'requests': sorted(stats['requests']) if 'requests' in stats else None,
+        'smaps': smaps.has_smaps('self'),
+        'postgresql': postgresql,
+        'database': 'PostgreSQL' if postgresql else 'Database',
+        'graph_total_named_users': options.get('graph_total_named_users', True),
+        'graph_admin_latency': options.get('graph_admin_latency', False),
+    })
+    return shape
+
+
+def render_config(name, shape):
+    lines = []
+    for graph in graphs:
+        if not shape[graph['when']]:
+            continue
+        lines.append("multigraph %s_%s" % (graph['graph'], name))
+        lines.append("graph_args %s" % graph['args'])
+        lines.append("graph_vlabel %s" % graph['vlabel'])
+        lines.append("graph_title %s - %s" % (name, graph['title'] % shape))
+        lines.append("graph_category Mendix")
+        lines.append("graph_info %s" % graph['info'])
+        fields = graph['fields']
+        if callable(fields):
+            fields = fields(shape)
+        for when, field, attributes in fields:
+            if when is not None and not shape[when]:
+                continue
+            for attribute, value in attributes:
+                lines.append("%s.%s %s" % (field, attribute, value))
+        lines.append("")
+    return _text(lines)
+
+
+def get_config_text(m2, name, shape):
+    """
+    Returns the rendered config for shape, which is stored in a little file,
+    so it only has to be rendered again when the shape changes.
+    """
+    config_text_cache = m2.config.get_munin_options().get(
+        'config_text_cache',
+        os.path.join(m2.config.get_default_dotm2ee_directory(),
+                     'munin-config-%s.json' % m2.config.get_admin_port()))
+    # the version changes along with the graphs table, so that a config that
+    # was rendered by an older version is not used anymore
+    key = json.dumps([CONFIG_TEXT_VERSION, name, shape], sort_keys=True)
     try:
-        with open(config_cache) as f:
-            stats = json.load(f)
-    except IOError as e:
-        logger.error("Error reading munin cache file %s: %s" %
-                     (config_cache, e))
-    except ValueError as e:
-        logger.error("Error parsing munin cache file %s: %s" %
-                     (config_cache, e))
-    return stats
-
-
-def print_requests_config(name, stats):
-    print("multigraph mxruntime_requests_%s" % name)
-    print("graph_args --base 1000 -l 0")
-    print("graph_vlabel Requests per second")
-    print("graph_title %s - MxRuntime Requests" % name)
-    print("graph_category Mendix")
-    print("graph_info This graph shows the amount of requests this MxRuntime handles")
-    for sub in stats['requests'].keys():
-        substrip = '_' + sub.strip('/').replace('-', '_')
-        if sub != '':
-            subname = sub
-        else:
-            subname = '/'
-        print("%s.label %s" % (substrip, subname))
-        print("%s.draw LINE1" % substrip)
-        print("%s.info amount of requests this MxRuntime handles on %s" % (substrip, subname))
-        print("%s.type DERIVE" % substrip)
-        print("%s.min 0" % substrip)
-    print("")
+        with open(config_text_cache) as f:
+            cached = json.load(f)
+        if cached['key'] == key:
+            return cached['text']
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+    text = render_config(name, shape)
+    logger.debug("Writing munin config text cache to %s" % config_text_cache)
+    try:
+        util.write_atomically(config_text_cache, json.dumps({'key': key, 'text': text}))
+    except (IOError, OSError) as e:
+        logger.error("Error writing munin config text cache %s: %s" % (config_text_cache, e))
+    return text
+
 
+def _text(lines):
+    return '\n'.join(lines) + '\n' if lines else ''
 
-def print_requests_values(name, stats):
-    print("multigraph mxruntime_requests_%s" % name)
+
+def requests_values(name, stats):
+    if "requests" not in stats:
+        return
+    yield "multigraph mxruntime_requests_%s" % name
     for sub, count in stats['requests'].items():
         substrip = '_' + sub.strip('/').replace('-', '_')
-        print("%s.value %s" % (substrip, count))
-    print("")
+        yield "%s.value %s" % (substrip, count)
+    yield ""
 
 
-def print_connectionbus_config(name, m2, stats):
+def connectionbus_values(name, stats):
     if 'connectionbus' not in stats:
         return
-    print("multigraph mxruntime_connectionbus_%s" % name)
-    print("graph_args --base 1000 -l 0")
-    print("graph_vlabel Statements per second")
-    if m2.config.is_using_postgresql():
-        print("graph_title %s - PostgreSQL queries" % name)
-    else:
-        print("graph_title %s - Database queries" % name)
-    print("graph_category Mendix")
-    print("graph_info This graph shows the amount of executed queries by type")
+    yield "multigraph mxruntime_connectionbus_%s" % name
     for s in ('select', 'insert', 'update', 'delete'):
-        print("%s.label %ss" % (s, s))
-        print("%s.draw LINE1" % s)
-        print("%s.info amount of %ss" % (s, s))
-        print("%s.type DERIVE" % s)
-        print("%s.min 0" % s)
-    print("")
+        yield "%s.value %s" % (s, stats['connectionbus'][s])
+    yield ""
 
 
-def print_connectionbus_values(name, stats):
-    if 'connectionbus' not in stats:
+def sessions_values(name, stats, graph_total_named_users):
+    if "sessions" not in stats:
         return
-    print("multigraph mxruntime_connectionbus_%s" % name)
-    for s in ('select', 'insert', 'update', 'delete'):
-        print("%s.value %s" % (s, stats['connectionbus'][s]))
-    print("")
+    yield "multigraph mxruntime_sessions_%s" % name
+    if graph_total_named_users:
+        yield "named_users.value %s" % stats['sessions']['named_users']
+    yield "named_user_sessions.value %s" % stats['sessions']['named_user_sessions']
+    yield "anonymous_sessions.value %s" % stats['sessions']['anonymous_sessions']
+    yield ""
 
 
-def print_sessions_config(name, stats, graph_total_named_users):
-    print("multigraph mxruntime_sessions_%s" % name)
-    print("graph_args --base 1000 -l 0")
-    print("graph_vlabel Concurrent user sessions")
-    print("graph_title %s - MxRuntime Users" % name)
-    print("graph_category Mendix")
-    print("graph_info This graph shows the amount of user accounts and sessions")
-    if graph_total_named_users:
-        print("named_users.label named users")
-        print("named_users.draw LINE1")
-        print("named_users.info total amount of named users in the application")
-    print("named_user_sessions.label concurrent named user sessions")
-    print("named_user_sessions.draw LINE1")
-    print("named_user_sessions.info amount of concurrent named user sessions")
-    print("anonymous_sessions.label concurrent anonymous user sessions")
-    print("anonymous_sessions.draw LINE1")
-    print("anonymous_sessions.info amount of concurrent anonymous user sessions")
-    print("")
-
-
-def print_sessions_values(name, stats, graph_total_named_users):
-    print("multigraph mxruntime_sessions_%s" % name)
-    if graph_total_named_users:
-        print("named_users.value %s" % stats['sessions']['named_users'])
-    print("named_user_sessions.value %s" %
-          stats['sessions']['named_user_sessions'])
-    print("anonymous_sessions.value %s" %
-          stats['sessions']['anonymous_sessions'])
-    print("")
-
-
-def print_jvmheap_config(name, stats):
-    print("multigraph mxruntime_jvmheap_%s" % name)
-    print("graph_args --base 1024 -l 0")
-    print("graph_vlabel Bytes")
-    print("graph_title %s - JVM Heap Memory Usage" % name)
-    print("graph_category Mendix")
-    print("graph_info This graph shows memory pool information on the Java JVM")
-    print("tenured.label tenured generation")
-    print("tenured.draw AREA")
-    print("tenured.info Old generation of the heap that holds long living objects")
-    print("tenured.colour COLOUR2")
-    print("survivor.label survivor space")
-    print("survivor.draw STACK")
-    print("survivor.info Survivor Space of the Young Generation")
-    print("survivor.colour COLOUR3")
-    print("eden.label eden space")
-    print("eden.draw STACK")
-    print("eden.info Objects are created in Eden")
-    print("eden.colour COLOUR4")
-    print("free.label unused")
-    print("free.draw STACK")
-    print("free.info Unused memory reserved for use by the JVM heap")
-    print("free.colour COLOUR5")
-    print("limit.label heap size limit")
-    print("limit.draw LINE1")
-    print("limit.info Java Heap memory usage limit")
-    print("limit.colour COLOUR6")
-    print("")
-
-
-def print_jvmheap_values(name, stats):
-    print("multigraph mxruntime_jvmheap_%s" % name)
+def jvmheap_values(name, stats):
+    if "memory" not in stats:
+        return
+    yield "multigraph mxruntime_jvmheap_%s" % name
     memory = stats['memory']
     for k in ['tenured', 'survivor', 'eden']:
-        print('%s.value %s' % (k, memory[k]))
+        yield '%s.value %s' % (k, memory[k])
     free = (memory['max_heap'] - memory['used_heap'])
-    print("free.value %s" % free)
-    print("limit.value %s" % memory['max_heap'])
-    print("")
+    yield "free.value %s" % free
+    yield "limit.value %s" % memory['max_heap']
+    yield ""
 
 
-def print_threadpool_config(name, stats):
-    if "threadpool" not in stats:
-        return
-    print("multigraph m2eeserver_threadpool_%s" % name)
-    print("graph_args --base 1000 -l 0")
-    print("graph_vlabel Jetty Threadpool")
-    print("graph_title %s - Jetty Threadpool" % name)
-    print("graph_category Mendix")
-    print("graph_info This graph shows threadpool usage information on Jetty")
-    print("min_threads.label min threads")
-    print("min_threads.draw LINE1")
-    print("min_threads.info Minimum number of threads")
-    print("max_threads.label max threads")
-    print("max_threads.draw LINE1")
-    print("max_threads.info Maximum number of threads")
-    print("active_threads.label active threads")
-    print("active_threads.draw LINE1")
-    print("active_threads.info Active thread count")
-    print("threadpool_size.label threadpool size")
-    print("threadpool_size.draw LINE1")
-    print("threadpool_size.info Current threadpool size")
-    print("")
-
-
-def print_threadpool_values(name, stats):
+def threadpool_values(name, stats):
     if "threadpool" not in stats:
         return
 
@@ -393,250 +838,110 @@ def print_threadpool_values(name, stats):
     idle_threads = stats['threadpool']['idle_threads']
     active_threads = threadpool_size - idle_threads
 
-    print("multigraph m2eeserver_threadpool_%s" % name)
-    print("min_threads.value %s" % min_threads)
-    print("max_threads.value %s" % max_threads)
-    print("active_threads.value %s" % active_threads)
-    print("threadpool_size.value %s" % threadpool_size)
-    print("")
+    yield "multigraph m2eeserver_threadpool_%s" % name
+    yield "min_threads.value %s" % min_threads
+    yield "max_threads.value %s" % max_threads
+    yield "active_threads.value %s" % active_threads
+    yield "threadpool_size.value %s" % threadpool_size
+    yield ""
 
 
-def print_cache_config(name, stats):
-    if "cache" not in stats:
-        return
-    print("multigraph mxruntime_cache_%s" % name)
-    print("graph_args --base 1000 -l 0")
-    print("graph_vlabel objects")
-    print("graph_title %s - Object Cache" % name)
-    print("graph_category Mendix")
-    print("graph_info This graph shows the total amount of objects in the runtime object cache")
-    print("total.label Objects in cache")
-    print("total.draw LINE1")
-    print("total.info Total amount of objects")
-    print("")
-
-
-def print_cache_values(name, stats):
+def cache_values(name, stats):
     if "cache" not in stats:
         return
-    print("multigraph mxruntime_cache_%s" % name)
-    print("total.value %s" % stats['cache']['total_count'])
-    print("")
+    yield "multigraph mxruntime_cache_%s" % name
+    yield "total.value %s" % stats['cache']['total_count']
+    yield ""
 
 
-def print_jvm_threads_config(name, stats):
-    if "threads" not in stats:
-        return
-    print("multigraph mxruntime_threads_%s" % name)
-    print("graph_args --base 1000 -l 0")
-    print("graph_vlabel threads")
-    print("graph_title %s - JVM Threads" % name)
-    print("graph_category Mendix")
-    print("graph_info This graph shows the total amount of threads in the JVM process")
-    print("total.label threads")
-    print("total.draw LINE1")
-    print("total.info Total amount of threads in the JVM process")
-    print("")
-
-
-def print_jvm_threads_values(name, stats):
+def jvm_threads_values(name, stats):
     if "threads" not in stats:
         return
-    print("multigraph mxruntime_threads_%s" % name)
-    print("total.value %s" % stats['threads'])
-    print("")
+    yield "multigraph mxruntime_threads_%s" % name
+    if "thread_states" in stats:
+        for state in threads.states:
+            yield "%s.value %s" % (state, stats['thread_states'][state])
+    yield "total.value %s" % stats['threads']
+    yield ""
 
 
-def print_jvm_process_memory_config(name):
-    if not smaps.has_smaps('self'):
-        return
-    print("multigraph mxruntime_jvm_process_memory_%s" % name)
-    print("graph_args --base 1024 -l 0")
-    print("graph_vlabel Bytes")
-    print("graph_title %s - JVM Process Memory Usage" % name)
-    print("graph_category Mendix")
-    print("graph_info This graph shows the total memory usage of the Java JVM process")
-    print("nativecode.label native code")
-    print("nativecode.draw AREA")
-    print("nativecode.info Native program code, e.g. the java binary itself")
-    print("jar.label jar files")
-    print("jar.draw STACK")
-    print("jar.info JAR file contents loaded into memory")
-    print("tenured.label tenured generation")
-    print("tenured.draw STACK")
-    print("tenured.info Old generation of the Java Heap that holds long living objects")
-    print("survivor.label survivor space")
-    print("survivor.draw STACK")
-    print("survivor.info Survivor Space of the Young Generation, Java Heap")
-    print("eden.label eden space")
-    print("eden.draw STACK")
-    print("eden.info Objects are created in Eden, Java Heap")
-    print("javaheap.label unused java heap")
-    print("javaheap.draw STACK")
-    print("javaheap.info Unused Java Heap")
-    print("permanent.label permanent generation")
-    print("permanent.draw STACK")
-    print("permanent.info Non-heap memory used to store bytecode versions of classes")
-    print("codecache.label code cache")
-    print("codecache.draw STACK")
-    print("codecache.info Non-heap memory used for compilation and storage of native code")
-    print("nativemem.label native memory")
-    print("nativemem.draw STACK")
-    print("nativemem.info Native heap and memory arenas")
-    print("stacks.label thread stacks")
-    print("stacks.draw STACK")
-    print("stacks.info Thread stacks")
-    print("other.label other")
-    print("other.draw STACK")
-    print("other.info Other, unknown, undetermined memory usage")
-    print("total.label total")
-    print("total.draw LINE1")
-    print("total.info Total memory usage")
-    print("")
-
-
-def print_jvm_process_memory_values(name, stats, pid, java_version):
-    if pid is None:
-        return
-    totals = smaps.get_smaps_rss_by_category(pid)
-    if totals is None:
+def jvm_process_memory_values(name, stats, totals, java_version):
+    if totals is None or "memory" not in stats:
         return
     memory = stats['memory']
-    print("multigraph mxruntime_jvm_process_memory_%s" % name)
-    print("nativecode.value %s" % (totals[smaps.CATEGORY_CODE] * 1024))
-    print("jar.value %s" % (totals[smaps.CATEGORY_JAR] * 1024))
+    yield "multigraph mxruntime_jvm_process_memory_%s" % name
+    yield "nativecode.value %s" % (totals[smaps.CATEGORY_CODE] * 1024)
+    yield "jar.value %s" % (totals[smaps.CATEGORY_JAR] * 1024)
 
     javaheap = totals[smaps.CATEGORY_JVM_HEAP] * 1024
     for k in ['tenured', 'survivor', 'eden']:
-        print('%s.value %s' % (k, memory[k]))
+        yield '%s.value %s' % (k, memory[k])
     if java_version is not None and java_version >= 8:
-        print("javaheap.value %s" % (javaheap - memory['used_heap'] - memory['code']))
+        yield "javaheap.value %s" % (javaheap - memory['used_heap'] - memory['code'])
     else:
-        print("javaheap.value %s" %
-              (javaheap - memory['used_heap'] - memory['code'] - memory['permanent']))
+        yield ("javaheap.value %s" %
+               (javaheap - memory['used_heap'] - memory['code'] - memory['permanent']))
 
     nativemem = totals[smaps.CATEGORY_NATIVE_HEAP_ARENA] * 1024
     othermem = totals[smaps.CATEGORY_OTHER] * 1024
-    print("permanent.value %s" % memory['permanent'])
-    print("codecache.value %s" % memory['code'])
+    yield "permanent.value %s" % memory['permanent']
+    yield "codecache.value %s" % memory['code']
     if java_version is not None and java_version >= 8:
-        print("nativemem.value %s" % (nativemem + othermem - memory['permanent']))
-        print("other.value 0")
+        yield "nativemem.value %s" % (nativemem + othermem - memory['permanent'])
+        yield "other.value 0"
     else:
-        print("nativemem.value %s" % nativemem)
-        print("other.value %s" % othermem)
-
-    print("stacks.value %s" % (totals[smaps.CATEGORY_THREAD_STACK] * 1024))
-    print("total.value %s" % (sum(totals.values()) * 1024))
-    print("")
-
-
-def print_pg_stat_database_config(name):
-    print("multigraph mxruntime_pg_stat_tuples_%s" % name)
-    print("graph_args -l 0")
-    print("graph_vlabel tuple mutations per second")
-    print("graph_title %s - PostgreSQL tuple mutations" % name)
-    print("graph_category Mendix")
-    print("graph_info This graph shows amount of tuple mutations")
-    print("tup_inserted.label tuples inserted")
-    print("tup_inserted.draw LINE1")
-    print("tup_inserted.min 0")
-    print("tup_inserted.type DERIVE")
-    print("tup_inserted.info Number of inserts")
-    print("tup_updated.label tuples updated")
-    print("tup_updated.draw LINE1")
-    print("tup_updated.min 0")
-    print("tup_updated.type DERIVE")
-    print("tup_updated.info Number of updates")
-    print("tup_deleted.label tuples deleted")
-    print("tup_deleted.draw LINE1")
-    print("tup_deleted.min 0")
-    print("tup_deleted.type DERIVE")
-    print("tup_deleted.info Number of deletes")
-    print("")
-
-
-def print_pg_stat_database_values(name, m2):
-    _, _, tup_inserted, tup_updated, tup_deleted = m2ee.pgutil.pg_stat_database(m2.config)
-    print("multigraph mxruntime_pg_stat_tuples_%s" % name)
-    print("tup_inserted.value %s" % tup_inserted)
-    print("tup_updated.value %s" % tup_updated)
-    print("tup_deleted.value %s" % tup_deleted)
-    print("")
-
-
-def print_pg_stat_activity_config(name):
-    print("multigraph mxruntime_pg_stat_activity_%s" % name)
-    print("graph_args -l 0")
-    print("graph_vlabel connections")
-    print("graph_title %s - PostgreSQL connections" % name)
-    print("graph_category Mendix")
-    print("graph_info This graph shows the amount of open database connections")
-    print("active.label active")
-    print("active.draw AREA")
-    print("active.info Amount of connections that currently execute a query "
-          "(including this monitoring plugin)")
-    print("idle_in_transaction.label idle in transaction")
-    print("idle_in_transaction.draw STACK")
-    print("idle_in_transaction.info Amount of idle transactions (e.g. running Mendix microflow "
-          "which is not executing a database operation right now.")
-    print("idle_in_transaction_aborted.label idle in transaction (aborted)")
-    print("idle_in_transaction_aborted.draw STACK")
-    print("idle_in_transaction_aborted.info Amount of idle transactions with errors")
-    print("idle.label idle")
-    print("idle.draw STACK")
-    print("idle.info Amount of idle (unused) but open connections")
-    print("total.label total")
-    print("total.draw LINE1")
-    print("total.colour 000000")
-    print("total.info Total amount of open connections as seen by PostgreSQL "
-          "(e.g. also including this monitoring query and things like backup dump operations)")
-    print("limit.label mendix runtime limit")
-    print("limit.draw LINE1")
-    print("limit.info Limit on amount of open connections for the "
-          "Mendix Runtime connection pooling")
-    print("")
-
-
-def print_pg_stat_activity_values(name, m2):
-    activity = m2ee.pgutil.pg_stat_activity(m2.config)
+        yield "nativemem.value %s" % nativemem
+        yield "other.value %s" % othermem
+
+    yield "stacks.value %s" % (totals[smaps.CATEGORY_THREAD_STACK] * 1024)
+    yield "total.value %s" % (sum(totals.values()) * 1024)
+    yield ""
+
+
+def get_pg_stats(m2, timeout):
+    """
+    Starts retrieving the database statistics in the background, returning
+    a future.
+    """
+    return M2EEExecutor().submit(m2.pg_stats.collect, timeout)
+
+
+def pg_stat_database_values(name, stat_database):
+    _, _, tup_inserted, tup_updated, tup_deleted = stat_database
+    yield "multigraph mxruntime_pg_stat_tuples_%s" % name
+    yield "tup_inserted.value %s" % tup_inserted
+    yield "tup_updated.value %s" % tup_updated
+    yield "tup_deleted.value %s" % tup_deleted
+    yield ""
+
+
+def pg_stat_activity_values(name, activity, limit):
     total = sum(activity.values())
-    limit = m2.config.get_max_active_db_connections()
-    print("multigraph mxruntime_pg_stat_activity_%s" % name)
-    print("active.value %s" % activity.get('active', 0))
-    print("idle.value %s" % activity.get('idle', 0))
-    print("idle_in_transaction.value %s" % activity.get('idle in transaction', 0))
-    print("idle_in_transaction_aborted.value %s" %
-          activity.get('idle in transaction (aborted)', 0))
-    print("total.value %s" % total)
-    print("limit.value %s" % limit)
-    print("")
-
-
-def print_pg_table_index_size_config(name):
-    print("multigraph mxruntime_pg_table_index_size_%s" % name)
-    print("graph_args --base 1024 --lower-limit 0")
-    print("graph_vlabel bytes")
-    print("graph_title %s - PostgreSQL database size" % name)
-    print("graph_category Mendix")
-    print("graph_info This graph shows the distribution of table and index size in a database")
-    print("tables.label tables")
-    print("tables.draw AREA")
-    print("tables.info Total disk space occupied by tables")
-    print("indexes.label indexes")
-    print("indexes.draw STACK")
-    print("indexes.info Total disk space occupied by indexes")
-    print("total.label total size")
-    print("total.draw LINE0")
-    print("total.colour 000000")
-    print("total.info Total database size")
-    print("")
-
-
-def print_pg_table_index_size_values(name, m2):
-    tables, indexes = m2ee.pgutil.pg_table_index_size(m2.config)
-    print("multigraph mxruntime_pg_table_index_size_%s" % name)
-    print("tables.value %s" % tables)
-    print("indexes.value %s" % indexes)
-    print("total.value %s" % (tables + indexes))
-    print("")
+    yield "multigraph mxruntime_pg_stat_activity_%s" % name
+    yield "active.value %s" % activity.get('active', 0)
+    yield "idle.value %s" % activity.get('idle', 0)
+    yield "idle_in_transaction.value %s" % activity.get('idle in transaction', 0)
+    yield ("idle_in_transaction_aborted.value %s" %
+           activity.get('idle in transaction (aborted)', 0))
+    yield "total.value %s" % total
+    yield "limit.value %s" % limit
+    yield ""
+
+
+def pg_table_index_size_values(name, table_index_size):
+    tables, indexes = table_index_size
+    yield "multigraph mxruntime_pg_table_index_size_%s" % name
+    yield "tables.value %s" % tables
+    yield "indexes.value %s" % indexes
+    yield "total.value %s" % (tables + indexes)
+    yield ""
+
+
+def admin_latency_values(name, summary, failed):
+    yield "multigraph mxruntime_admin_latency_%s" % name
+    for action in admin_latency_actions:
+        if summary is not None and action in summary:
+            yield "%s.value %.3f" % (action, summary[action]['max_ms'] / 1000)
+    if failed is not None:
+        yield "failed.value %s" % failed
+    yield ""
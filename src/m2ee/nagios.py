@@ -18,15 +18,62 @@ STATE_CRITICAL = 2
 STATE_UNKNOWN = 3
 STATE_DEPENDENT = 4
 
+# seconds to wait for the application
+TIMEOUT = 10
+
+
+def check(runner, client, snapshot_cache=None):
+    """
+    Prints the nagios plugin output and returns its state. When a
+    snapshot_cache is given, the outcome is shared with other checks that
+    run shortly after each other, like the ones for different services of
+    the same application.
+    """
+    if snapshot_cache is None:
+        state, message, loglines = evaluate(runner, client)
+    else:
+        result = snapshot_cache.get(
+            'nagios', lambda timeout: evaluate(runner, client, timeout), timeout=TIMEOUT)
+        if result is None:
+            result = (STATE_UNKNOWN, "Another check of this application did not finish "
+                      "within %s seconds" % TIMEOUT, None)
+        state, message, loglines = result
+    print(message)
+    if loglines is not None:
+        print('\n'.join(loglines))
+    return state
+
 
-def check(runner, client):
-    process_state, process_message = check_process(runner, client)
+def evaluate(runner, client, timeout=TIMEOUT):
+    actions = [
+        ("echo", {"echo": "ping"}),
+        ("about", None),
+        ("runtime_status", None),
+        ("check_health", None),
+        ("get_license_information", None),
+    ]
+    # Don't ask the runtime for things we already know about it.
+    feedback = {}
+    capabilities = client.cached_capabilities()
+    if capabilities is not None:
+        feedback["about"] = capabilities['about']
+        for action in ("check_health", "get_license_information"):
+            if action not in capabilities['actions']:
+                feedback[action] = M2EEAdminException(
+                    action, {"result": M2EEAdminException.ERR_ACTION_NOT_FOUND})
+    todo = [(action, params) for action, params in actions if action not in feedback]
+    feedback.update(zip([action for action, _ in todo], client.batch(todo, timeout=timeout)))
+    echo, about, runtime_status, health, license_info = [
+        feedback[action] for action, _ in actions
+    ]
+
+    process_state, process_message = check_process(runner, echo, about, runtime_status)
     logger.trace("check_process: %s, %s" % (process_state, process_message))
 
     state = process_state
     message = process_message
 
-    health_state, health_message = check_health(client)
+    health_state, health_message = check_health(health)
     logger.trace("check_health: %s, %s" % (health_state, health_message))
 
     if health_state in (STATE_WARNING, STATE_CRITICAL):
@@ -34,7 +81,7 @@ def check(runner, client):
         if state != STATE_CRITICAL:
             state = health_state
 
-    critical_log_state, critical_log_message, loglines = check_critical_logs(client)
+    critical_log_state, critical_log_message, loglines = check_critical_logs(echo)
     logger.trace("check_critical_logs: %s, %s" % (critical_log_state, critical_log_message))
 
     if critical_log_state in (STATE_WARNING, STATE_CRITICAL):
@@ -42,7 +89,7 @@ def check(runner, client):
         if state != STATE_CRITICAL:
             state = critical_log_state
 
-    license_state, license_message = check_license(client)
+    license_state, license_message = check_license(license_info)
     logger.trace("check_license: %s, %s" % (license_state, license_message))
 
     if license_state in (STATE_WARNING, STATE_CRITICAL):
@@ -50,16 +97,21 @@ def check(runner, client):
         if state != STATE_CRITICAL:
             state = license_state
 
-    print(message)
-    if loglines is not None:
-        print('\n'.join(loglines))
-    return state
+    return state, message, loglines
+
+
+def _result(feedback):
+    # Results from a batch of admin requests contain the exception instead of
+    # the feedback if something went wrong.
+    if isinstance(feedback, Exception):
+        raise feedback
+    return feedback
 
 
-def check_process(runner, client):
+def check_process(runner, echo, about, runtime_status):
     pid = runner.get_pid()
     pid_alive = runner.check_pid()
-    m2ee_alive = client.ping()
+    m2ee_alive = not isinstance(echo, Exception)
 
     if m2ee_alive is False:
         if pid is None:
@@ -80,7 +132,7 @@ def check_process(runner, client):
         pid_message = "Process with pid %s cannot receive signals" % runner.get_pid()
 
     try:
-        version_message = "Using Runtime %s" % client.about(timeout=5)['version']
+        version_message = "Using Runtime %s" % _result(about)['version']
     except (M2EEAdminException, M2EEAdminNotAvailable,
             M2EEAdminHTTPException, M2EEAdminTimeout) as e:
         version_message = ""
@@ -88,7 +140,7 @@ def check_process(runner, client):
     state = STATE_OK
     m2ee_message = "Application is running"
     try:
-        runtime_status = client.runtime_status(timeout=5)['status']
+        runtime_status = _result(runtime_status)['status']
         if runtime_status == 'starting':
             state = STATE_WARNING
             m2ee_message = "Application is still starting up..."
@@ -108,9 +160,9 @@ def check_process(runner, client):
     return (state, message)
 
 
-def check_health(client):
+def check_health(feedback):
     try:
-        feedback = client.check_health(timeout=10)
+        feedback = _result(feedback)
         if feedback['health'] == 'healthy':
             return STATE_OK, "Healthy"
         elif feedback['health'] == 'sick':
@@ -131,9 +183,10 @@ def check_health(client):
         return STATE_WARNING, "Admin API timeout, health could not be determined"
 
 
-def check_critical_logs(client):
+def check_critical_logs(echo):
     try:
-        errors = client.get_critical_log_messages(timeout=5)
+        echo = _result(echo)
+        errors = echo['errors'] if echo['echo'] != "pong" else []
         if len(errors) != 0:
             return STATE_CRITICAL, "%d critical error(s) were logged" % len(errors), errors
         return STATE_OK, "No critical log messages", None
@@ -146,9 +199,9 @@ def check_critical_logs(client):
         return STATE_WARNING, "Admin API timeout, critical log messages could not be checked", None
 
 
-def check_license(client):
+def check_license(feedback):
     try:
-        feedback = client.get_license_information(timeout=5)
+        feedback = _result(feedback)
         if 'license' not in feedback:
             return STATE_OK, "No license activated"
         expiry = feedback['license'].get('ExpirationDate', None)
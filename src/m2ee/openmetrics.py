@@ -0,0 +1,270 @@
+#
+# Copyright (C) 2009 Mendix. All rights reserved.
+#
+
+import logging
+import threading
+import time
+
+import m2ee.munin
+import m2ee.smaps as smaps
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+smaps_category_names = {
+    smaps.CATEGORY_CODE: 'code',
+    smaps.CATEGORY_NATIVE_HEAP_ARENA: 'native_heap',
+    smaps.CATEGORY_JVM_HEAP: 'jvm_heap',
+    smaps.CATEGORY_THREAD_STACK: 'thread_stack',
+    smaps.CATEGORY_JAR: 'jar',
+    smaps.CATEGORY_OTHER: 'other',
+    smaps.CATEGORY_NONE: 'none',
+}
+
+
+class MetricFamily:
+
+    def __init__(self, name, metric_type, help_text, unit=None):
+        self.name = name
+        self.metric_type = metric_type
+        self.help_text = help_text
+        self.unit = unit
+        self.samples = []
+
+    def add(self, value, **labels):
+        self.samples.append((labels, value))
+        return self
+
+    def lines(self):
+        yield "# TYPE %s %s" % (self.name, self.metric_type)
+        if self.unit is not None:
+            yield "# UNIT %s %s" % (self.name, self.unit)
+        yield "# HELP %s %s" % (self.name, self.help_text)
+        suffix = '_total' if self.metric_type == 'counter' else ''
+        for labels, value in self.samples:
+            if labels:
+                yield "%s%s{%s} %s" % (self.name, suffix, ','.join(
+                    '%s="%s"' % (key, _escape(labels[key])) for key in sorted(labels)), value)
+            else:
+                yield "%s%s %s" % (self.name, suffix, value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def get_metric_families(values):
+    """
+    Converts the information collected by m2ee.munin.get_values into a list
+    of metric families. Information that is missing is left out.
+    """
+    families = []
+    stats = values['stats'] or {}
+
+    if 'requests' in stats:
+        family = MetricFamily("mendix_requests", "counter",
+                              "Amount of handled requests per request handler")
+        for handler, count in sorted(stats['requests'].items()):
+            family.add(count, handler=handler)
+        families.append(family)
+
+    if 'connectionbus' in stats:
+        family = MetricFamily("mendix_database_statements", "counter",
+                              "Amount of executed database statements by type")
+        for statement in ('select', 'insert', 'update', 'delete', 'transaction'):
+            if statement in stats['connectionbus']:
+                family.add(stats['connectionbus'][statement], type=statement)
+        families.append(family)
+
+    if 'sessions' in stats:
+        sessions = stats['sessions']
+        families.append(
+            MetricFamily("mendix_sessions", "gauge", "Amount of user sessions")
+            .add(sessions['named_user_sessions'], type="named")
+            .add(sessions['anonymous_sessions'], type="anonymous"))
+        families.append(
+            MetricFamily("mendix_named_users", "gauge",
+                         "Total amount of named users in the application")
+            .add(sessions['named_users']))
+
+    if 'memory' in stats:
+        memory = stats['memory']
+        family = MetricFamily("mendix_jvm_memory_bytes", "gauge",
+                              "Memory usage of the JVM by memory pool", "bytes")
+        for pool in ('eden', 'survivor', 'tenured', 'permanent', 'code'):
+            if pool in memory:
+                family.add(memory[pool], pool=pool)
+        families.append(family)
+        family = MetricFamily("mendix_jvm_heap_bytes", "gauge", "JVM heap memory", "bytes")
+        for kind in ('used', 'committed', 'max'):
+            if '%s_heap' % kind in memory:
+                family.add(memory['%s_heap' % kind], type=kind)
+        families.append(family)
+
+    if 'threadpool' in stats:
+        threadpool = stats['threadpool']
+        families.append(
+            MetricFamily("mendix_threadpool_threads", "gauge",
+                         "Threads of the threadpool that handles HTTP requests")
+            .add(threadpool['min_threads'], type="min")
+            .add(threadpool['max_threads'], type="max")
+            .add(threadpool['threads'], type="size")
+            .add(threadpool['threads'] - threadpool['idle_threads'], type="active"))
+
+    if 'cache' in stats:
+        families.append(
+            MetricFamily("mendix_cache_objects", "gauge",
+                         "Amount of objects in the runtime object cache")
+            .add(stats['cache']['total_count']))
+
+    if 'thread_states' in stats:
+        family = MetricFamily("mendix_jvm_threads", "gauge",
+                              "Amount of threads in the JVM process by state")
+        for state, count in sorted(stats['thread_states'].items()):
+            family.add(count, state=state)
+        families.append(family)
+    elif 'threads' in stats:
+        families.append(
+            MetricFamily("mendix_jvm_threads", "gauge",
+                         "Amount of threads in the JVM process")
+            .add(stats['threads']))
+
+    if values.get('smaps') is not None:
+        family = MetricFamily("mendix_jvm_process_memory_bytes", "gauge",
+                              "Resident memory of the JVM process by category", "bytes")
+        for category, kilobytes in sorted(values['smaps'].items()):
+            family.add(kilobytes * 1024, category=smaps_category_names[int(category)])
+        families.append(family)
+
+    if values.get('pg_stat_database') is not None:
+        commits, rollbacks, inserted, updated, deleted = values['pg_stat_database']
+        families.append(
+            MetricFamily("mendix_pg_transactions", "counter",
+                         "Amount of database transactions")
+            .add(commits, result="commit")
+            .add(rollbacks, result="rollback"))
+        families.append(
+            MetricFamily("mendix_pg_tuples", "counter", "Amount of tuple mutations")
+            .add(inserted, operation="inserted")
+            .add(updated, operation="updated")
+            .add(deleted, operation="deleted"))
+
+    if values.get('pg_stat_activity') is not None:
+        family = MetricFamily("mendix_pg_connections", "gauge",
+                              "Open database connections by state")
+        for state, count in sorted(values['pg_stat_activity'].items()):
+            family.add(count, state=state)
+        families.append(family)
+        families.append(
+            MetricFamily("mendix_pg_connections_limit", "gauge",
+                         "Limit on open database connections of the runtime")
+            .add(values['max_active_db_connections']))
+
+    if values.get('pg_table_index_size') is not None:
+        tables, indexes = values['pg_table_index_size']
+        families.append(
+            MetricFamily("mendix_pg_size_bytes", "gauge",
+                         "Disk space used by the database", "bytes")
+            .add(tables, type="tables")
+            .add(indexes, type="indexes"))
+
+    return families
+
+
+def render(values, timestamp):
+    lines = []
+    for family in get_metric_families(values):
+        lines.extend(family.lines())
+    lines.extend([
+        "# TYPE mendix_snapshot_timestamp_seconds gauge",
+        "# UNIT mendix_snapshot_timestamp_seconds seconds",
+        "# HELP mendix_snapshot_timestamp_seconds Time at which these metrics were collected",
+        "mendix_snapshot_timestamp_seconds %.3f" % timestamp,
+        "# EOF",
+    ])
+    return '\n'.join(lines) + '\n'
+
+
+class M2EEMetricsExporter:
+    """
+    Serves the statistics of an application in the OpenMetrics text format
+    over HTTP, for Prometheus and friends. The statistics are collected every
+    interval seconds in the background. Scrapes always get the most recent
+    collected snapshot, so the amount of scrapes does not influence the load
+    on the application.
+    """
+
+    def __init__(self, m2, host='127.0.0.1', port=9393, interval=15):
+        self._m2 = m2
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._httpd = _ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        self._httpd.exporter = self
+
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot
+
+    def refresh(self):
+        start = time.time()
+        text = render(m2ee.munin.get_values(self._m2), start)
+        with self._lock:
+            self._snapshot = text.encode('utf-8')
+        logger.debug("Collected metrics in %.3f seconds" % (time.time() - start))
+
+    def _refresh_loop(self):
+        while True:
+            start = time.time()
+            try:
+                self._m2.reload_config_if_changed()
+                self.refresh()
+            except Exception as e:
+                logger.error("Collecting metrics failed: %s" % e)
+            time.sleep(max(0, self._interval - (time.time() - start)))
+
+    def serve_forever(self):
+        thread = threading.Thread(target=self._refresh_loop)
+        thread.daemon = True
+        thread.start()
+        logger.info("Serving metrics on http://%s:%s/metrics, refreshing every %s seconds" %
+                    (self._httpd.server_address[0], self._httpd.server_address[1],
+                     self._interval))
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.trace("Metrics exporter: " + format % args)
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        snapshot = self.server.exporter.snapshot()
+        if snapshot is None:
+            self.send_error(503, "No metrics collected yet")
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(snapshot)))
+        self.end_headers()
+        self.wfile.write(snapshot)
@@ -2,134 +2,544 @@
 # Copyright (C) 2009 Mendix. All rights reserved.
 #
 
+import errno
+import hashlib
 import logging
+import math
 import os
+import shutil
 import subprocess
+import tempfile
+import threading
 import time
+import zlib
 from m2ee.exceptions import M2EEException
 
 logger = logging.getLogger(__name__)
 
-
-def dumpdb(config, name=None):
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSOR_GZIP = 'gzip'
+COMPRESSOR_ZSTD = 'zstd'
+# zstd when the zstandard module is available, otherwise gzip
+COMPRESSOR_AUTO = 'auto'
+
+compressor_suffixes = {
+    COMPRESSOR_GZIP: '.gz',
+    COMPRESSOR_ZSTD: '.zst',
+}
+
+CHUNK_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 10
+PG_STATS_TIMEOUT = 10
+
+
+# the compression levels that can be used with pg_dump itself (None) and
+# with the compressors
+compression_levels = {
+    None: (0, 9),
+    COMPRESSOR_GZIP: (0, 9),
+    COMPRESSOR_ZSTD: (1, 19),
+}
+
+
+def get_dump_options(config, jobs=None, compression=None, compressor=None):
+    """
+    Returns the amount of jobs, the compression level and the compressor to
+    use for a database dump, using the configured ones for the ones that are
+    None. Raises an M2EEException when they can't be used, so that can be
+    found out before starting a dump.
+    """
+    options = config.get_database_dump_options()
+    if jobs is None:
+        jobs = options['jobs']
+    if compression is None:
+        compression = options['compression']
+    if compressor is None:
+        compressor = options['compressor']
+
+    if not isinstance(jobs, int) or jobs < 1:
+        raise M2EEException("The amount of jobs for a database dump needs to be at least 1")
+    if compressor in (None, 'none'):
+        compressor = None
+    elif jobs > 1:
+        logger.warn("Not using compressor %s for a dump using %d jobs, pg_dump compresses "
+                    "the files of a directory dump itself" % (compressor, jobs))
+        compressor = None
+    elif compressor == COMPRESSOR_AUTO:
+        compressor = COMPRESSOR_GZIP if zstandard is None else COMPRESSOR_ZSTD
+    elif compressor not in compressor_suffixes:
+        raise M2EEException("Unknown database dump compressor %s, use one of %s, %s or "
+                            "none" % (compressor, COMPRESSOR_AUTO,
+                                      ', '.join(sorted(compressor_suffixes))))
+    elif compressor == COMPRESSOR_ZSTD and zstandard is None:
+        logger.warn("Using gzip instead of zstd to compress the database dump, because the "
+                    "zstandard python module is not installed")
+        compressor = COMPRESSOR_GZIP
+
+    low, high = compression_levels[compressor]
+    if compression is not None and (not isinstance(compression, int) or
+                                    not low <= compression <= high):
+        raise M2EEException("The compression level for %s needs to be between %d and %d, "
+                            "not %s" % (compressor or 'pg_dump', low, high, compression))
+    return jobs, compression, compressor
+
+
+def dumpdb(config, name=None, jobs=None, compression=None, compressor=None):
+    """
+    Creates a database dump in the database dump path. When using more than
+    one job, the dump is made in directory format, in which pg_dump writes
+    the tables in parallel into separate files in a directory, compressed
+    with the given compression level (0-9) or the default of pg_dump.
+
+    Otherwise a single file in custom format is written. Its contents are
+    streamed from pg_dump into the file, while the progress is logged and a
+    sha256 checksum is computed, which is written next to it, and which
+    restoredb verifies. pg_dump compresses the data in it itself, unless a
+    compressor other than 'none' is used. In that case, the whole dump is
+    compressed while streaming it, using gzip or zstd ('auto' picks zstd
+    when available), and it can't be restored in parallel.
+    """
     env = os.environ.copy()
     env.update(config.get_pg_environment())
 
+    jobs, compression, compressor = get_dump_options(config, jobs, compression, compressor)
+    directory = jobs > 1
+
     if name is None:
-        name = ("%s_%s.backup"
-                % (env['PGDATABASE'], time.strftime("%Y%m%d_%H%M%S"))
-                )
+        name = config.get_database_dump_name(env['PGDATABASE'], directory)
+        if compressor is not None:
+            name += compressor_suffixes[compressor]
 
     db_dump_file_name = os.path.join(config.get_database_dump_path(), name)
 
-    logger.info("Writing database dump to %s" % db_dump_file_name)
-    cmd = (config.get_pg_dump_binary(), "-O", "-x", "-F", "c")
+    if not directory:
+        logger.info("Writing %sdatabase dump to %s" % (
+            "" if compressor is None else "%s compressed " % compressor, db_dump_file_name))
+        _dump_streamed(config.get_pg_dump_binary(), env, db_dump_file_name,
+                       compressor, compression)
+        return
+
+    logger.info("Writing database dump to directory %s using %d jobs" %
+                (db_dump_file_name, jobs))
+    cmd = (config.get_pg_dump_binary(), "-O", "-x", "-F", "d", "-j", str(jobs),
+           "-f", db_dump_file_name)
+    if compression is not None:
+        cmd = cmd + ("-Z", str(compression))
     logger.trace("Executing %s" % str(cmd))
     try:
-        proc = subprocess.Popen(cmd, env=env, stdout=open(db_dump_file_name, 'w+'),
-                                stderr=subprocess.PIPE)
+        proc = subprocess.Popen(cmd, env=env, stderr=subprocess.PIPE,
+                                universal_newlines=True)
         (_, stderr) = proc.communicate()
 
-        if stderr != '':
+        if proc.returncode != 0:
+            _remove_dump(db_dump_file_name)
             raise M2EEException("An error occured while creating database dump: %s" %
                                 stderr.strip())
     except OSError as e:
-        raise M2EEException("Database dump failed, cmd: %s" % cmd, e)
-
-
-def restoredb(config, dump_name):
+        raise M2EEException("Database dump failed, cmd: %s" % str(cmd), e)
+    if stderr.strip():
+        logger.warn(stderr.strip())
+
+
+def _remove_dump(db_dump_file_name):
+    # don't leave a broken dump behind that looks like a good one
+    if os.path.isdir(db_dump_file_name):
+        shutil.rmtree(db_dump_file_name, ignore_errors=True)
+    for filename in (db_dump_file_name, db_dump_file_name + '.sha256'):
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+
+def _dump_streamed(pg_dump, env, db_dump_file_name, compressor, compression):
+    """
+    Lets pg_dump write a dump in custom format to its stdout, and streams it
+    into db_dump_file_name, through compressor if given, computing the
+    checksum of the file on the way. When using a compressor, pg_dump does
+    not compress the data itself.
+    """
+    cmd = (pg_dump, "-O", "-x", "-F", "c")
+    if compressor is not None:
+        cmd = cmd + ("-Z", "0")
+    elif compression is not None:
+        cmd = cmd + ("-Z", str(compression))
+    logger.trace("Executing %s" % str(cmd))
+    checksum = hashlib.sha256()
+    progress = _Progress("Dumped")
+    try:
+        # a file instead of a pipe, so pg_dump can't get stuck writing to
+        # stderr while we're reading its stdout
+        with tempfile.TemporaryFile() as stderr:
+            try:
+                proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=stderr)
+            except OSError as e:
+                raise M2EEException("Database dump failed, cmd: %s" % str(cmd), e)
+            try:
+                with open(db_dump_file_name, 'wb') as f:
+                    compress, flush = _compressor(compressor, compression)
+                    for chunk in iter(lambda: proc.stdout.read(CHUNK_SIZE), b''):
+                        data = compress(chunk)
+                        f.write(data)
+                        checksum.update(data)
+                        progress.add(len(chunk), len(data) if compressor else 0)
+                    data = flush()
+                    f.write(data)
+                    checksum.update(data)
+                    progress.add(0, len(data))
+            finally:
+                proc.stdout.close()
+                proc.wait()
+            stderr.seek(0)
+            errors = stderr.read().decode('utf-8', 'replace').strip()
+        if proc.returncode != 0:
+            raise M2EEException("An error occured while creating database dump: %s" % errors)
+        _write_checksum(db_dump_file_name, checksum.hexdigest())
+    except (IOError, OSError) as e:
+        _remove_dump(db_dump_file_name)
+        raise M2EEException("Unable to write database dump %s: %s" % (db_dump_file_name, e), e)
+    except Exception:
+        _remove_dump(db_dump_file_name)
+        raise
+    if errors:
+        logger.warn(errors)
+    progress.done()
+
+
+def _compressor(compressor, level):
+    if compressor is None:
+        return (lambda data: data), (lambda: b'')
+    if compressor == COMPRESSOR_ZSTD:
+        cctx = zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+        return cctx.compress, cctx.flush
+    # a gzip header and trailer, so the file can also be read with gunzip
+    cobj = zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return cobj.compress, cobj.flush
+
+
+def _decompressed_chunks(f, compressor, progress=None):
+    """
+    Yields the decompressed contents of f, which was compressed using
+    compressor.
+    """
+    if compressor == COMPRESSOR_ZSTD:
+        dobj = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        dobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+        data = dobj.decompress(chunk)
+        # files concatenated using cat are still valid gzip files
+        while compressor == COMPRESSOR_GZIP and dobj.unused_data:
+            rest = dobj.unused_data
+            dobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data += dobj.decompress(rest)
+        if progress is not None:
+            progress.add(len(data), len(chunk))
+        yield data
+    if compressor == COMPRESSOR_GZIP:
+        yield dobj.flush()
+
+
+def _write_checksum(db_dump_file_name, hexdigest):
+    # the format of sha256sum, so the dump can also be checked with sha256sum -c
+    with open(db_dump_file_name + '.sha256', 'w') as f:
+        f.write("%s  %s\n" % (hexdigest, os.path.basename(db_dump_file_name)))
+
+
+def _read_checksum(db_dump_file_name):
+    """
+    Returns the sha256 checksum that was written for the dump, or None if
+    there is none.
+    """
+    try:
+        with open(db_dump_file_name + '.sha256') as f:
+            return f.read().split()[0].lower()
+    except IndexError:
+        raise M2EEException("Checksum file %s.sha256 is empty" % db_dump_file_name)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise M2EEException("Unable to read checksum file %s.sha256: %s" %
+                                (db_dump_file_name, e), e)
+        return None
+
+
+def verify_checksum(db_dump_file_name):
+    """
+    Reads the whole dump file to check whether it matches the sha256
+    checksum that was written for it, if there is one, and raises an
+    M2EEException if it doesn't. This is done before restoring anything,
+    since the restore programs can not be stopped from committing a
+    corrupt dump in time.
+    """
+    expected = _read_checksum(db_dump_file_name)
+    if expected is None:
+        return
+    logger.info("Verifying the checksum of %s" % db_dump_file_name)
+    checksum = hashlib.sha256()
+    progress = _Progress("Verified")
+    try:
+        with open(db_dump_file_name, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                checksum.update(chunk)
+                progress.add(len(chunk), 0)
+    except IOError as e:
+        raise M2EEException("Unable to read database dump %s: %s" % (db_dump_file_name, e), e)
+    progress.done()
+    if checksum.hexdigest() != expected:
+        raise M2EEException("Database dump %s does not match its checksum in %s.sha256" %
+                            (db_dump_file_name, db_dump_file_name))
+
+
+class _Progress:
+    """
+    Logs the amount of bytes that were processed every PROGRESS_INTERVAL
+    seconds, and how fast that goes.
+    """
+
+    def __init__(self, action):
+        self._action = action
+        self._start = time.time()
+        self._last = self._start
+        self.raw = 0
+        self.compressed = 0
+
+    def add(self, raw, compressed):
+        self.raw += raw
+        self.compressed += compressed
+        now = time.time()
+        if now - self._last >= PROGRESS_INTERVAL:
+            self._last = now
+            self._log(now)
+
+    def done(self):
+        self._log(time.time())
+
+    def _log(self, now):
+        elapsed = max(now - self._start, 0.001)
+        mib = self.raw / 1048576.0
+        compressed = ""
+        if self.compressed > 0:
+            compressed = " (%.1f MiB compressed)" % (self.compressed / 1048576.0)
+        logger.info("%s %.1f MiB%s in %.0f seconds, %.1f MiB/s" %
+                    (self._action, mib, compressed, elapsed, mib / elapsed))
+
+
+FORMAT_PLAIN = 'plain'
+FORMAT_CUSTOM = 'custom'
+FORMAT_DIRECTORY = 'directory'
+FORMAT_TAR = 'tar'
+
+
+def detect_dump_format(path):
+    """
+    Returns the format of the database dump at path (FORMAT_PLAIN,
+    FORMAT_CUSTOM, FORMAT_DIRECTORY or FORMAT_TAR), and the compressor
+    (COMPRESSOR_GZIP or COMPRESSOR_ZSTD) that was used to compress the whole
+    dump file afterwards, or None.
+    """
+    if os.path.isdir(path):
+        if not os.path.isfile(os.path.join(path, 'toc.dat')):
+            raise M2EEException("Directory %s is not a database dump" % path)
+        return FORMAT_DIRECTORY, None
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(262)
+            compressor = None
+            if head[:2] == b'\x1f\x8b':
+                compressor = COMPRESSOR_GZIP
+            elif head[:4] == b'\x28\xb5\x2f\xfd':
+                compressor = COMPRESSOR_ZSTD
+                if zstandard is None:
+                    raise M2EEException("Database dump %s is compressed using zstd, which "
+                                        "needs the zstandard python module" % path)
+            if compressor is not None:
+                f.seek(0)
+                head = b''
+                for data in _decompressed_chunks(f, compressor):
+                    head += data
+                    if len(head) >= 262:
+                        break
+    except (IOError, OSError, zlib.error) as e:
+        raise M2EEException("Unable to read database dump %s: %s" % (path, e), e)
+    if head[:5] == b'PGDMP':
+        return FORMAT_CUSTOM, compressor
+    if head[257:262] == b'ustar':
+        return FORMAT_TAR, compressor
+    return FORMAT_PLAIN, compressor
+
+
+def restoredb(config, dump_name, jobs=None):
+    """
+    Restores a database dump from the database dump path, in any format
+    pg_dump can write, or a plain or custom format dump that was compressed
+    using gzip or zstd. Custom and directory format dumps are restored using
+    jobs parallel jobs, in which pg_restore also creates indexes and
+    constraints in parallel after all data has been loaded.
+
+    Compressed dumps are decompressed while streaming them to pg_restore,
+    which can only use a single job then. When there is a sha256 checksum
+    file next to the dump, the dump is checked first, and nothing is
+    restored when it doesn't match.
+    """
     env = os.environ.copy()
     env.update(config.get_pg_environment())
+    # plain dumps are full of notices when executed
+    env['PGOPTIONS'] = (env.get('PGOPTIONS', '') + ' -c client_min_messages=warning').strip()
+
+    if jobs is None:
+        jobs = config.get_database_dump_options()['jobs']
 
     db_dump_file_name = os.path.join(
         config.get_database_dump_path(), dump_name
     )
-    logger.debug("Restoring %s" % db_dump_file_name)
-    cmd = (config.get_pg_restore_binary(), "-d", env['PGDATABASE'],
-           "-O", "-n", "public", "-x", db_dump_file_name)
+    dump_format, compressor = detect_dump_format(db_dump_file_name)
+    if dump_format != FORMAT_DIRECTORY:
+        verify_checksum(db_dump_file_name)
+    logger.info("Restoring %s dump %s%s" % (
+        dump_format, db_dump_file_name,
+        "" if compressor is None else " (%s compressed)" % compressor))
+    if dump_format == FORMAT_PLAIN:
+        cmd = (config.get_psql_binary(), "-q", "-X", "-v", "ON_ERROR_STOP=1")
+    else:
+        cmd = (config.get_pg_restore_binary(), "-d", env['PGDATABASE'],
+               "-O", "-n", "public", "-x")
+        if jobs > 1 and dump_format in (FORMAT_CUSTOM, FORMAT_DIRECTORY):
+            # pg_restore can only run jobs in parallel when it can seek in the dump
+            if compressor is None:
+                cmd = cmd + ("-j", str(jobs))
+            else:
+                logger.warn("Restoring using a single job instead of %d, because a "
+                            "dump compressed using %s can not be restored in parallel" %
+                            (jobs, compressor))
+    if compressor is not None:
+        progress = _Progress("Restored")
+        try:
+            with open(db_dump_file_name, 'rb') as f:
+                _run_restore(cmd, env, _decompressed_chunks(f, compressor, progress))
+        except (IOError, zlib.error) as e:
+            raise M2EEException("Unable to read database dump %s: %s" %
+                                (db_dump_file_name, e), e)
+        progress.done()
+    elif dump_format == FORMAT_PLAIN:
+        _run_restore(cmd + ("-f", db_dump_file_name), env)
+    else:
+        _run_restore(cmd + (db_dump_file_name,), env)
+
+
+def _run_restore(cmd, env, chunks=None):
+    """
+    Runs cmd, while streaming chunks to it if given, and raises an
+    M2EEException when it fails.
+    """
     logger.trace("Executing %s" % str(cmd))
-    try:
-        proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        (stdout, stderr) = proc.communicate()
-
-        if stderr != '':
-            raise M2EEException("An error occured while doing database restore: %s " %
-                                stderr.strip())
-    except OSError as e:
-        raise M2EEException("Database restore failed, cmd: %s" % cmd, e)
+    # a file instead of a pipe, so we can't get stuck writing to stdin while
+    # stderr is full
+    with tempfile.TemporaryFile() as stderr, open(os.devnull, 'w') as devnull:
+        try:
+            proc = subprocess.Popen(cmd, env=env, stdout=devnull, stderr=stderr,
+                                    stdin=None if chunks is None else subprocess.PIPE)
+        except OSError as e:
+            raise M2EEException("Database restore failed, cmd: %s" % str(cmd), e)
+        if chunks is not None:
+            try:
+                for chunk in chunks:
+                    try:
+                        proc.stdin.write(chunk)
+                    except (IOError, OSError) as e:
+                        # the restore program exited early, its errors tell why
+                        logger.debug("Stopped streaming the dump: %s" % e)
+                        break
+            except Exception:
+                # don't let the restore program see a dump that could not be
+                # read completely as the end of its input
+                proc.kill()
+                proc.wait()
+                raise
+            finally:
+                try:
+                    proc.stdin.close()
+                except (IOError, OSError):
+                    pass
+        proc.wait()
+        stderr.seek(0)
+        errors = stderr.read().decode('utf-8', 'replace').strip()
+    if proc.returncode != 0:
+        raise M2EEException("An error occured while doing database restore: %s " % errors)
+    if errors:
+        logger.warn(errors)
+
+
+# Drops all tables and sequences that are visible to the application in a
+# single statement per kind, inside the database server. Sequences that
+# belong to a table are already gone after dropping the tables.
+emptydb_query = """
+SELECT sum(CASE WHEN c.relkind = 'r' THEN 1 ELSE 0 END),
+       sum(CASE WHEN c.relkind = 'S' THEN 1 ELSE 0 END)
+FROM pg_catalog.pg_class AS c
+LEFT JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+WHERE c.relkind IN ('r', 'S') AND n.nspname NOT IN ('pg_catalog', 'pg_toast')
+AND pg_catalog.pg_table_is_visible(c.oid);
+DO $$
+DECLARE
+    kind record;
+    objects text;
+BEGIN
+    FOR kind IN SELECT * FROM (VALUES ('r', 'TABLE'), ('S', 'SEQUENCE')) AS k(relkind, name)
+    LOOP
+        SELECT string_agg(quote_ident(n.nspname) || '.' || quote_ident(c.relname), ', ')
+        INTO objects
+        FROM pg_catalog.pg_class AS c
+        LEFT JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+        WHERE c.relkind::text = kind.relkind AND n.nspname NOT IN ('pg_catalog', 'pg_toast')
+        AND pg_catalog.pg_table_is_visible(c.oid);
+        IF objects IS NOT NULL THEN
+            EXECUTE 'DROP ' || kind.name || ' ' || objects || ' CASCADE';
+        END IF;
+    END LOOP;
+END
+$$;
+"""
 
 
 def emptydb(config):
+    """
+    Drops all tables and sequences from the database in a single transaction,
+    so either everything or nothing is removed. Returns the amount of
+    tables and sequences that were removed.
+    """
     env = os.environ.copy()
     env.update(config.get_pg_environment())
+    env['PGOPTIONS'] = (env.get('PGOPTIONS', '') + ' -c client_min_messages=warning').strip()
 
-    logger.info("Removing all tables...")
-    # get list of drop table commands
-    cmd1 = (
-        config.get_psql_binary(), "-t", "-c",
-        "SELECT 'DROP TABLE ' || n.nspname || '.\"' || c.relname || '\" CASCADE;' "
-        "FROM pg_catalog.pg_class AS c LEFT JOIN pg_catalog.pg_namespace AS n "
-        "ON n.oid = c.relnamespace WHERE relkind = 'r' AND n.nspname NOT IN "
-        "('pg_catalog', 'pg_toast') AND pg_catalog.pg_table_is_visible(c.oid)"
-    )
-    logger.trace("Executing %s, creating pipe for stdout,stderr" % str(cmd1))
-    try:
-        proc1 = subprocess.Popen(cmd1, env=env, stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-        (stdout1, stderr1) = proc1.communicate()
-
-        if stderr1 != '':
-            raise M2EEException("Emptying database (step 1) failed: %s" % stderr1.strip())
-    except OSError as e:
-        raise M2EEException("Emptying database (step 1) failed, cmd: %s" % cmd1, e)
-
-    stdin2 = stdout1
-    cmd2 = (config.get_psql_binary(),)
-    logger.trace("Piping stdout,stderr to %s" % str(cmd2))
-    try:
-        proc2 = subprocess.Popen(cmd2, env=env, stdin=subprocess.PIPE,
-                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        (stdout2, stderr2) = proc2.communicate(stdin2)
-
-        if stderr2 != '':
-            raise M2EEException("Emptying database (step 2) failed: %s" % stderr2.strip())
-    except OSError as e:
-        raise M2EEException("Emptying database (step 2) failed, cmd: %s" % cmd2, e)
-
-    logger.info("Removing all sequences...")
-    # get list of drop sequence commands
-    cmd3 = (
-        config.get_psql_binary(), "-t", "-c",
-        "SELECT 'DROP SEQUENCE ' || n.nspname || '.\"' || c.relname || '\" "
-        "CASCADE;' FROM pg_catalog.pg_class AS c LEFT JOIN "
-        "pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace WHERE "
-        "relkind = 'S' AND n.nspname NOT IN ('pg_catalog', 'pg_toast') AND "
-        "pg_catalog.pg_table_is_visible(c.oid)"
-    )
-    logger.trace("Executing %s, creating pipe for stdout,stderr" % str(cmd3))
-    try:
-        proc3 = subprocess.Popen(cmd3, env=env, stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-        (stdout3, stderr3) = proc3.communicate()
-
-        if stderr3 != '':
-            raise M2EEException("Emptying database (step 3) failed: %s" % stderr3.strip())
-    except OSError as e:
-        raise M2EEException("Emptying database (step 3) failed, cmd: %s" % cmd3, e)
-
-    stdin4 = stdout3
-    cmd4 = (config.get_psql_binary(),)
-    logger.trace("Piping stdout,stderr to %s" % str(cmd4))
+    logger.info("Removing all tables and sequences...")
+    start = time.time()
+    # -1 only works for a script given with -f, not for plain stdin
+    cmd = (config.get_psql_binary(), "-X", "-q", "-A", "-t", "-1", "-v", "ON_ERROR_STOP=1",
+           "-f", "-")
+    logger.trace("Executing %s" % str(cmd))
     try:
-        proc4 = subprocess.Popen(cmd4, env=env, stdin=subprocess.PIPE,
-                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        (stdout4, stderr4) = proc4.communicate(stdin4)
-
-        if stderr4 != '':
-            raise M2EEException("Emptying database (step 4) failed: %s" % stderr4.strip())
+        proc = subprocess.Popen(cmd, env=env, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        (stdout, stderr) = proc.communicate(emptydb_query)
     except OSError as e:
-        raise M2EEException("Emptying database (step 4) failed, cmd: %s" % cmd4, e)
+        raise M2EEException("Emptying database failed, cmd: %s" % str(cmd), e)
+    if proc.returncode != 0:
+        # one transaction holds a lock on every table, which might need a
+        # higher max_locks_per_transaction for very large models
+        raise M2EEException("Emptying database failed: %s" % stderr.strip())
+    tables, sequences = [int(x or 0) for x in stdout.strip().split('|')]
+    logger.info("Removed %d tables and %d sequences in %.1f seconds." %
+                (tables, sequences, time.time() - start))
+    return tables, sequences
 
 
 def psql(config):
@@ -155,7 +565,7 @@ def pg_stat_database(config):
     )
     try:
         proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
+                                stderr=subprocess.PIPE, universal_newlines=True)
         (stdout, stderr) = proc.communicate()
         if stderr != '':
             raise M2EEException("Retrieving pg_stat_database info failed: %s" % stderr.strip())
@@ -178,7 +588,7 @@ def pg_stat_activity(config):
     )
     try:
         proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
+                                stderr=subprocess.PIPE, universal_newlines=True)
         (stdout, stderr) = proc.communicate()
         if stderr != '':
             raise M2EEException("Retrieving pg_stat_activity info failed: %s" % stderr.strip())
@@ -204,5 +614,155 @@ def pg_table_index_size(config):
         """FROM (SELECT ('"' || table_schema || '"."' || table_name || '"') """
         "        AS table_name FROM information_schema.tables) AS foo"
     )
-    output = subprocess.check_output(cmd, env=env)
+    output = subprocess.check_output(cmd, env=env, universal_newlines=True)
     return [int(x) for x in output.split('|')]
+
+
+# All statistics queries, with a tag in front of every row to tell them apart
+# when they're run together in a single psql session. Parameters are written
+# as psql variables, see _psycopg2_query for the native driver version.
+pg_stats_queries = (
+    "SELECT 'pg_stat_database', xact_commit, xact_rollback, tup_inserted, "
+    "tup_updated, tup_deleted FROM pg_stat_database WHERE datname = :'datname'",
+    "SELECT 'pg_stat_activity', count(*), state FROM pg_stat_activity "
+    "WHERE datname = :'datname' AND usename = :'usename' GROUP BY 3",
+    "SELECT 'pg_table_index_size', sum(pg_table_size(table_name::regclass)), "
+    "sum(pg_indexes_size(table_name::regclass)) "
+    """FROM (SELECT ('"' || table_schema || '"."' || table_name || '"') """
+    "        AS table_name FROM information_schema.tables) AS foo",
+)
+
+
+class M2EEPgStatsCollector:
+    """
+    Retrieves the pg_stat_database, pg_stat_activity and pg_table_index_size
+    statistics all at once, using a single database session. When the
+    psycopg2 module is available, the connection is kept open to be used
+    again the next time, otherwise a single psql process runs all queries.
+    Opening fewer connections also makes the amount of connections in
+    pg_stat_activity more accurate.
+    """
+
+    def __init__(self, config):
+        self._config = config
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def collect(self, timeout=PG_STATS_TIMEOUT):
+        """
+        Returns a dict with the same results as the pg_stat_database,
+        pg_stat_activity and pg_table_index_size functions, by name.
+        Connecting, and each of the queries, is limited to timeout
+        seconds, so a database that does not respond does not keep other
+        threads waiting for the lock forever.
+        """
+        env = self._config.get_pg_environment()
+        deadline = time.time() + timeout
+        while not self._lock.acquire(False):
+            if time.time() >= deadline:
+                raise M2EEException("Retrieving database statistics failed: "
+                                    "timed out waiting for another collection")
+            time.sleep(0.05)
+        try:
+            if psycopg2 is not None:
+                rows = self._query_psycopg2(env, deadline)
+            else:
+                rows = self._query_psql(env, deadline)
+        finally:
+            self._lock.release()
+        result = {'pg_stat_activity': {}}
+        for row in rows:
+            name, values = row[0], row[1:]
+            if name == 'pg_stat_activity':
+                count, state = values
+                result[name][state if state is not None else ''] = int(count)
+            else:
+                result[name] = [int(x) for x in values]
+        if 'pg_stat_database' not in result:
+            raise M2EEException("Database %s not found in pg_stat_database" %
+                                env['PGDATABASE'])
+        return result
+
+    def _query_psycopg2(self, env, deadline):
+        params = {'datname': env['PGDATABASE'], 'usename': env['PGUSER']}
+        for attempt in (1, 2):
+            try:
+                if self._connection is None or self._connection.closed:
+                    self._connection = psycopg2.connect(
+                        host=env['PGHOST'], port=env['PGPORT'], user=env['PGUSER'],
+                        password=env['PGPASSWORD'], dbname=env['PGDATABASE'],
+                        application_name='m2ee',
+                        connect_timeout=_seconds_left(deadline))
+                    # statistics are read as a snapshot at the start of a
+                    # transaction, so don't keep one open
+                    self._connection.autocommit = True
+                rows = []
+                with self._connection.cursor() as cursor:
+                    for query in pg_stats_queries:
+                        cursor.execute("SET statement_timeout = %s",
+                                       (_seconds_left(deadline) * 1000,))
+                        cursor.execute(_psycopg2_query(query), params)
+                        rows.extend(cursor.fetchall())
+                return rows
+            except psycopg2.OperationalError as e:
+                # the server might have closed the connection we kept
+                self.close()
+                if attempt == 2:
+                    raise M2EEException("Retrieving database statistics failed: %s" % e, e)
+            except psycopg2.Error as e:
+                raise M2EEException("Retrieving database statistics failed: %s" % e, e)
+
+    def _query_psql(self, env, deadline):
+        timeout = _seconds_left(deadline)
+        pg_env = os.environ.copy()
+        pg_env.update(env)
+        pg_env['PGCONNECT_TIMEOUT'] = str(timeout)
+        pg_env['PGOPTIONS'] = (pg_env.get('PGOPTIONS', '') +
+                               ' -c statement_timeout=%d' % (timeout * 1000)).strip()
+        cmd = (
+            self._config.get_psql_binary(), "-X", "-q", "-A", "-t",
+            "-v", "ON_ERROR_STOP=1",
+            "-v", "datname=%s" % env['PGDATABASE'],
+            "-v", "usename=%s" % env['PGUSER'],
+        )
+        logger.trace("Executing %s" % str(cmd))
+        try:
+            proc = subprocess.Popen(cmd, env=pg_env, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    universal_newlines=True)
+        except OSError as e:
+            raise M2EEException("Retrieving database statistics failed, cmd: %s" % str(cmd), e)
+        # statement_timeout applies to each query separately, so also put a
+        # limit on psql as a whole
+        timer = threading.Timer(timeout, proc.kill)
+        timer.daemon = True
+        timer.start()
+        try:
+            (stdout, stderr) = proc.communicate(';\n'.join(pg_stats_queries) + ';\n')
+        finally:
+            timer.cancel()
+        if proc.returncode < 0:
+            raise M2EEException("Retrieving database statistics failed: "
+                                "psql did not finish within %d seconds" % timeout)
+        if proc.returncode != 0 or stderr != '':
+            raise M2EEException("Retrieving database statistics failed: %s" % stderr.strip())
+        return [line.split('|') for line in stdout.splitlines() if line]
+
+    def close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except psycopg2.Error:
+                pass
+            self._connection = None
+
+
+def _seconds_left(deadline):
+    # the timeouts of libpq are in whole seconds, and 0 means no timeout
+    return max(1, int(math.ceil(deadline - time.time())))
+
+
+def _psycopg2_query(query):
+    # psql variables to psycopg2 parameters, and escape the rest
+    return query.replace('%', '%%').replace(":'datname'", "%(datname)s") \
+        .replace(":'usename'", "%(usename)s")
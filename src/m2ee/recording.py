@@ -0,0 +1,164 @@
+#
+# Copyright (C) 2009 Mendix. All rights reserved.
+#
+
+import copy
+import fcntl
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+from m2ee.client import M2EEAdminException, M2EEAdminHTTPException, \
+    M2EEAdminNotAvailable, M2EEAdminTimeout, M2EERuntimeNotFullyRunning
+from m2ee.exceptions import M2EEException
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+
+def _key(action, params):
+    return action, json.dumps(params or None, sort_keys=True)
+
+
+def _error(e):
+    if isinstance(e, M2EEAdminException):
+        return {"type": "M2EEAdminException", "response": e.json}
+    if isinstance(e, M2EERuntimeNotFullyRunning):
+        return {"type": "M2EERuntimeNotFullyRunning", "status": e.status}
+    return {"type": type(e).__name__, "message": str(e)}
+
+
+def _exception(action, error):
+    kind = error['type']
+    if kind == "M2EEAdminException":
+        return M2EEAdminException(action, error['response'])
+    if kind == "M2EERuntimeNotFullyRunning":
+        return M2EERuntimeNotFullyRunning(error['status'], action)
+    exception_class = {
+        "M2EEAdminTimeout": M2EEAdminTimeout,
+        "M2EEAdminHTTPException": M2EEAdminHTTPException,
+    }.get(kind, M2EEAdminNotAvailable)
+    return exception_class(error['message'])
+
+
+class M2EERecorder:
+    """
+    Transport for M2EEClient which passes all admin requests on to the
+    application, while writing every request together with its outcome and
+    the time it took to a gzipped file with a json document per line. The
+    file can be used later on by M2EEReplayer.
+
+    Every line is written as a separate gzip member while holding a lock on
+    the file, so multiple processes can record to the same file at the same
+    time without corrupting it.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self._write({"version": FORMAT_VERSION, "started": self._start})
+        logger.debug("Recording admin requests to %s" % filename)
+
+    def _write(self, entry):
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        member = compressor.compress(line.encode('utf-8')) + compressor.flush()
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                # a single write of a complete member, so the recording is
+                # usable even when we get killed
+                while member:
+                    member = member[os.write(self._fd, member):]
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def send(self, post, action, params, timeout):
+        start = time.time()
+        entry = {"at": round(start - self._start, 6), "action": action, "params": params}
+        try:
+            feedback = post(action, params, timeout)
+            entry["feedback"] = feedback
+            return feedback
+        except (M2EEAdminException, M2EEAdminHTTPException, M2EEAdminNotAvailable,
+                M2EEAdminTimeout, M2EERuntimeNotFullyRunning) as e:
+            entry["error"] = _error(e)
+            raise
+        finally:
+            if "feedback" in entry or "error" in entry:
+                entry["duration"] = round(time.time() - start, 6)
+                self._write(entry)
+
+    def close(self):
+        with self._lock:
+            os.close(self._fd)
+
+
+class M2EEReplayer:
+    """
+    Transport for M2EEClient which answers admin requests from a file that
+    was written by M2EERecorder, without contacting an application at all.
+
+    Requests are matched on action and params. When the same request was done
+    multiple times, the recorded responses are returned in the same order,
+    starting at the first one again when all of them have been used. Every
+    response is delayed by the recorded duration multiplied by speed, so 0
+    replays as fast as possible.
+    """
+
+    def __init__(self, filename, speed=1.0):
+        self._filename = filename
+        self._speed = speed
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._next = {}
+        with gzip.open(filename, 'rb') as f:
+            try:
+                for line in f:
+                    self._add(json.loads(line.decode('utf-8')))
+            except (EOFError, IOError, ValueError) as e:
+                # a recording that was interrupted misses its end
+                logger.warn("Admin recording %s is incomplete, using what could be "
+                            "read: %s" % (filename, e))
+        logger.debug("Replaying %d different admin requests from %s" %
+                     (len(self._entries), filename))
+
+    def _add(self, entry):
+        if 'action' not in entry:
+            if entry.get('version') != FORMAT_VERSION:
+                raise M2EEException("Unsupported admin recording format in %s: %s" %
+                                    (self._filename, entry.get('version')))
+            return
+        key = _key(entry['action'], entry['params'])
+        self._entries.setdefault(key, []).append(entry)
+
+    def send(self, post, action, params, timeout):
+        key = _key(action, params)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise M2EEAdminNotAvailable(
+                    "Admin request %s with params %s was not recorded in %s" %
+                    (action, key[1], self._filename))
+            index = self._next.get(key, 0)
+            self._next[key] = (index + 1) % len(entries)
+        entry = entries[index]
+        delay = entry['duration'] * self._speed
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise M2EEAdminTimeout("Admin API does not respond. Timeout reached after "
+                                   "%s seconds." % timeout)
+        time.sleep(delay)
+        if 'error' in entry:
+            raise _exception(action, entry['error'])
+        return copy.deepcopy(entry['feedback'])
+
+    def close(self):
+        pass
@@ -0,0 +1,233 @@
+#
+# Copyright (C) 2009 Mendix. All rights reserved.
+#
+
+from __future__ import print_function
+import gzip
+import json
+import logging
+import numbers
+import os
+import time
+
+from m2ee.client import M2EEAdminException, M2EEAdminNotAvailable, \
+    M2EEAdminHTTPException, M2EEAdminTimeout, M2EERuntimeNotFullyRunning
+from m2ee.exceptions import M2EEException
+import m2ee.munin
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+# Statistics that only go up while the application is running. For these,
+# the report shows the rate per second instead of the value.
+counter_prefixes = ('requests.', 'connectionbus.', 'process.cpu_seconds')
+
+
+def flatten(stats, prefix=''):
+    """
+    Turns nested statistics into a flat dict of numeric values, with the
+    path to every value as key, e.g. threadpool.idle_threads.
+    """
+    result = {}
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            result.update(flatten(value, '%s%s.' % (prefix, key)))
+        elif isinstance(value, numbers.Real) and not isinstance(value, bool):
+            result['%s%s' % (prefix, key)] = value
+    return result
+
+
+def get_process_stats(pid):
+    """
+    Returns the cpu time used and the resident memory of process pid, or an
+    empty dict when that's not available.
+    """
+    try:
+        with open('/proc/%s/stat' % pid) as f:
+            stat = f.read()
+        with open('/proc/%s/statm' % pid) as f:
+            statm = f.read().split()
+    except EnvironmentError:
+        return {}
+    # see proc(5), utime and stime are fields 14 and 15, counting the command
+    # (that can contain spaces) as field 2
+    fields = stat[stat.rfind(')') + 2:].split()
+    return {
+        'cpu_seconds': (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK')),
+        'rss_bytes': int(statm[1]) * os.sysconf('SC_PAGE_SIZE'),
+    }
+
+
+def get_sample(m2, timeout):
+    stats, _ = m2ee.munin.get_stats_from_runtime(m2, timeout)
+    stats.get('sessions', {}).pop('user_sessions', None)
+    pid = m2.runner.get_pid()
+    if pid is not None:
+        stats['process'] = get_process_stats(pid)
+    return flatten(stats)
+
+
+class M2EEStatisticsRecorder:
+    """
+    Writes samples of the statistics of the application to a gzipped file
+    with a json document per line. Only the first sample contains all
+    values, every next one only contains the difference with the previous
+    one for values that changed, which keeps the file small when sampling
+    often. The file can be read with read_samples.
+    """
+
+    def __init__(self, m2, filename):
+        self._m2 = m2
+        self._filename = filename
+        self._last = {}
+
+    def record(self, duration, interval):
+        start = time.time()
+        with gzip.open(self._filename, 'wb') as f:
+            self._write(f, {"version": FORMAT_VERSION, "started": start,
+                            "interval": interval})
+            count = 0
+            while True:
+                at = time.time()
+                self._write(f, self._sample(int(round((at - start) * 1000)),
+                                            max(interval, 1)))
+                count += 1
+                # keep to the schedule, skipping samples that would be late
+                next_at = start + interval * (int((time.time() - start) / interval) + 1)
+                if next_at - start > duration:
+                    break
+                time.sleep(max(0, next_at - time.time()))
+        return count
+
+    def _sample(self, ms, timeout):
+        try:
+            values = get_sample(self._m2, timeout)
+        except (M2EEAdminException, M2EEAdminNotAvailable,
+                M2EEAdminHTTPException, M2EEAdminTimeout,
+                M2EERuntimeNotFullyRunning) as e:
+            logger.warn("Unable to sample statistics: %s" % e)
+            return {"t": ms, "error": str(e)}
+        entry = {"t": ms}
+        new = dict((k, v) for k, v in values.items() if k not in self._last)
+        changed = dict((k, _round(v - self._last[k])) for k, v in values.items()
+                       if k in self._last and v != self._last[k])
+        missing = [k for k in self._last if k not in values]
+        if new:
+            entry["n"] = new
+        if changed:
+            entry["d"] = changed
+        if missing:
+            entry["m"] = sorted(missing)
+        self._last = values
+        return entry
+
+    def _write(self, f, entry):
+        f.write((json.dumps(entry, separators=(',', ':')) + '\n').encode('utf-8'))
+
+
+def _round(value):
+    return round(value, 6) if isinstance(value, float) else value
+
+
+def read_samples(filename):
+    """
+    Returns the header of a file written by M2EEStatisticsRecorder and a
+    list of (seconds since start, values) for every sample. The values are
+    None for samples that failed.
+    """
+    header = None
+    samples = []
+    last = {}
+    with gzip.open(filename, 'rb') as f:
+        try:
+            for line in f:
+                entry = json.loads(line.decode('utf-8'))
+                if header is None:
+                    if entry.get('version') != FORMAT_VERSION:
+                        raise M2EEException("Unsupported statistics recording format in %s: "
+                                            "%s" % (filename, entry.get('version')))
+                    header = entry
+                    continue
+                if 'error' in entry:
+                    samples.append((entry['t'] / 1000.0, None))
+                    continue
+                values = dict(last)
+                for key in entry.get('m', []):
+                    del values[key]
+                values.update(entry.get('n', {}))
+                for key, delta in entry.get('d', {}).items():
+                    values[key] = _round(values[key] + delta)
+                samples.append((entry['t'] / 1000.0, values))
+                last = values
+        except (EOFError, IOError, ValueError) as e:
+            # a recording that was interrupted misses its end
+            logger.warn("Statistics recording %s is incomplete, using what could be "
+                        "read: %s" % (filename, e))
+    if header is None:
+        raise M2EEException("%s is not a statistics recording" % filename)
+    return header, samples
+
+
+def _percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+
+def summarize(samples):
+    """
+    Returns a list of dicts with percentiles of every value in samples, or of
+    its rate per second when it's a counter.
+    """
+    series = {}
+    previous = None
+    for at, values in samples:
+        if values is None:
+            previous = None
+            continue
+        for key, value in values.items():
+            if not key.startswith(counter_prefixes):
+                series.setdefault(key, []).append(value)
+            elif previous is not None and key in previous[1] and at > previous[0]:
+                rate = (value - previous[1][key]) / (at - previous[0])
+                # a counter going down means the application was restarted
+                if rate >= 0:
+                    series.setdefault(key, []).append(rate)
+        previous = (at, values)
+    result = []
+    for key in sorted(series):
+        ordered = sorted(series[key])
+        result.append({
+            "name": key,
+            "rate": key.startswith(counter_prefixes),
+            "samples": len(ordered),
+            "min": ordered[0],
+            "p50": _percentile(ordered, 50),
+            "p90": _percentile(ordered, 90),
+            "p99": _percentile(ordered, 99),
+            "max": ordered[-1],
+        })
+    return result
+
+
+def print_report(filename):
+    header, samples = read_samples(filename)
+    failed = len([values for _, values in samples if values is None])
+    print("Recorded %d samples every %s seconds during %.1f seconds, starting at %s "
+          "(%d failed)" % (len(samples), header['interval'],
+                           samples[-1][0] if samples else 0,
+                           time.strftime("%Y-%m-%d %H:%M:%S",
+                                         time.localtime(header['started'])),
+                           failed))
+    print("%-48s %8s %12s %12s %12s %12s %12s" %
+          ("statistic", "samples", "min", "p50", "p90", "p99", "max"))
+    for summary in summarize(samples):
+        print("%-48s %8d %12s %12s %12s %12s %12s" % (
+            summary['name'] + (" (/s)" if summary['rate'] else ""), summary['samples'],
+            _format(summary['min']), _format(summary['p50']), _format(summary['p90']),
+            _format(summary['p99']), _format(summary['max'])))
+
+
+def _format(value):
+    if isinstance(value, float) and value != int(value):
+        return "%.2f" % value
+    return "%d" % value
@@ -0,0 +1,183 @@
+#
+# Copyright (C) 2009 Mendix. All rights reserved.
+#
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import time
+
+from m2ee import util
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+
+class M2EESnapshotCache:
+    """
+    Stores information that was retrieved from the application, like
+    statistics, in a file together with the time it was retrieved. All m2ee
+    processes for the same application (the munin and nagios plugins, the
+    CLI, etc.) that need the same information within ttl seconds reuse it,
+    instead of all asking the application themselves.
+
+    When the information has to be refreshed, a lock file per name makes
+    sure that only one process does so, while the others wait for its result,
+    but never longer than they are prepared to wait for the application
+    itself. The last stored information is also kept around after it
+    expires, to be used when the application is not available, or when
+    another process is busy refreshing it for too long.
+    """
+
+    def __init__(self, filename, ttl=10):
+        self._filename = filename
+        self._ttl = ttl
+
+    def get(self, name, fetch, ttl=None, timeout=10, compact=None):
+        """
+        Returns the information stored as name if it's not older than ttl
+        seconds, or calls fetch to retrieve and store it again. fetch gets
+        the amount of seconds that are left of timeout as argument. When
+        compact is given, it is called with the retrieved information, and
+        returns a copy of it without the parts that don't need to be stored.
+
+        When another process is refreshing the same information, this waits
+        for it until timeout seconds have passed. After that, the last stored
+        information is returned, or, if there is none, None.
+        """
+        if ttl is None:
+            ttl = self._ttl
+        deadline = time.time() + timeout
+        if ttl > 0:
+            data = self._get_fresh(name, ttl)
+            if data is not None:
+                return data
+        with self._locked(name, deadline) as lock:
+            if not lock.acquired:
+                data = self.last(name)
+                if data is not None:
+                    logger.debug("Another process is still refreshing %s, using the last "
+                                 "stored one" % name)
+                    return data
+                logger.warn("Another process is still refreshing %s, and there is "
+                            "no earlier one to use" % name)
+                return None
+            # Somebody else might have refreshed it while we were waiting.
+            if ttl > 0:
+                data = self._get_fresh(name, ttl)
+                if data is not None:
+                    return data
+            data = fetch(max(0, deadline - time.time()))
+            self._store(name, data, compact)
+            return data
+
+    def last(self, name):
+        """
+        Returns the information that was stored last as name, regardless of
+        how old it is, or None.
+        """
+        entry = self._read().get(name)
+        return None if entry is None else entry['data']
+
+    def _get_fresh(self, name, ttl):
+        entry = self._read().get(name)
+        if entry is not None and 0 <= time.time() - entry['time'] < ttl:
+            logger.trace("Reusing %s from %s" % (name, self._filename))
+            return entry['data']
+        return None
+
+    def _read(self):
+        try:
+            with open(self._filename) as f:
+                snapshot = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                logger.error("Error reading snapshot cache %s: %s" % (self._filename, e))
+            return {}
+        except ValueError as e:
+            logger.debug("Ignoring invalid snapshot cache %s: %s" % (self._filename, e))
+            return {}
+        if not isinstance(snapshot, dict) or snapshot.get('version') != FORMAT_VERSION:
+            logger.debug("Ignoring snapshot cache %s with unknown format" % self._filename)
+            return {}
+        entries = snapshot.get('entries')
+        if not isinstance(entries, dict):
+            return {}
+        return dict(
+            (name, entry) for name, entry in entries.items()
+            if isinstance(entry, dict) and 'time' in entry and 'data' in entry
+        )
+
+    def _store(self, name, data, compact=None):
+        if compact is not None:
+            data = compact(data)
+        logger.debug("Writing %s to snapshot cache %s" % (name, self._filename))
+        # Entries are refreshed independently, so only hold a lock on the
+        # file itself while updating it, to not lose the update of another
+        # entry. This never takes long.
+        with _FileLock(self._filename + '.lock'):
+            entries = self._read()
+            entries[name] = {'time': time.time(), 'data': data}
+            try:
+                # Readers don't take the lock, so never let them see a half
+                # written file.
+                util.write_atomically(self._filename, json.dumps(
+                    {'version': FORMAT_VERSION, 'entries': entries}, separators=(',', ':')))
+            except (IOError, OSError) as e:
+                logger.error("Error writing snapshot cache %s: %s" % (self._filename, e))
+
+    def _locked(self, name, deadline):
+        return _FileLock('%s.%s.lock' % (self._filename, name), deadline)
+
+
+class _FileLock:
+    """
+    Holds an exclusive lock on filename. Without a deadline, this waits as
+    long as it takes to get the lock. Otherwise, it gives up at the deadline,
+    and acquired tells whether the lock was taken.
+    """
+
+    def __init__(self, filename, deadline=None):
+        self._filename = filename
+        self._deadline = deadline
+        self._fd = None
+        self.acquired = False
+
+    def __enter__(self):
+        try:
+            self._fd = os.open(self._filename, os.O_RDWR | os.O_CREAT, 0o600)
+            if self._deadline is None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+                self.acquired = True
+            else:
+                self.acquired = self._acquire_before_deadline()
+        except (IOError, OSError) as e:
+            # not being able to lock only means doing some work twice
+            logger.error("Unable to lock %s: %s" % (self._filename, e))
+            self.acquired = True
+        if not self.acquired:
+            self._close()
+        return self
+
+    def _acquire_before_deadline(self):
+        while True:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if time.time() >= self._deadline:
+                return False
+            time.sleep(min(0.05, max(0, self._deadline - time.time())))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._close()
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,244 @@
+#
+# Copyright (C) 2009 Mendix. All rights reserved.
+#
+
+from base64 import b64encode
+import json
+import logging
+import threading
+import time
+
+from m2ee.client import M2EEAdminException
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+logger = logging.getLogger(__name__)
+
+
+def default_feedback(payload_size=10, version="7.23.0", java_version="1.8.0_202"):
+    """
+    Returns canned feedback for the admin actions that m2ee-tools uses while
+    monitoring an application. The payload_size determines the amount of
+    threads, logged in users, sessions and critical log messages in the
+    responses, so the size of the larger responses can be scaled up.
+    """
+    mb = 1024 * 1024
+    pools = [
+        ("Code Cache", 20 * mb),
+        ("Compressed Class Space", 10 * mb),
+        ("Metaspace", 80 * mb),
+        ("PS Eden Space", 150 * mb),
+        ("PS Survivor Space", 5 * mb),
+        ("PS Old Gen", 300 * mb),
+    ]
+    users = ["user%d" % i for i in range(payload_size)]
+    return {
+        "echo": {"echo": "pong"},
+        "about": {
+            "name": "Mendix Runtime",
+            "version": version,
+            "java_version": java_version,
+            "company": "Mendix",
+            "copyright": "Copyright (c) Mendix",
+            "model_version": "1.0.0.%d" % payload_size,
+        },
+        "runtime_status": {"status": "running"},
+        "check_health": {"health": "healthy"},
+        "get_license_information": {},
+        "get_critical_log_messages": [
+            "Critical log message %d" % i for i in range(payload_size)
+        ],
+        "get_logged_in_user_names": {"count": len(users), "users": users},
+        "get_all_thread_stack_traces": dict(
+            ("Thread-%d" % i, [
+                "java.lang.Object.wait(Native Method)",
+                "java.lang.Thread.run(Thread.java:%d)" % (748 + i),
+            ])
+            for i in range(payload_size)
+        ),
+        "runtime_statistics": {
+            "languages": ["en_US"],
+            "entities": payload_size,
+            "memory": {
+                "init_heap": 64 * mb,
+                "used_heap": 455 * mb,
+                "committed_heap": 700 * mb,
+                "max_heap": 1024 * mb,
+                "init_nonheap": 2 * mb,
+                "used_nonheap": 110 * mb,
+                "committed_nonheap": 120 * mb,
+                "max_nonheap": -1,
+                "memorypools": [
+                    {"index": i, "name": name, "usage": usage}
+                    for i, (name, usage) in enumerate(pools)
+                ],
+            },
+            "sessions": {
+                "named_users": payload_size,
+                "anonymous_sessions": 0,
+                "named_user_sessions": payload_size,
+                "user_sessions": dict((user, 1) for user in users),
+            },
+            "requests": {
+                "": 100, "debugger/": 0, "ws/": 10, "xas/": 1000, "ws-doc/": 0, "file": 50,
+            },
+            "cache": {"total_count": 10 * payload_size, "disk_count": 0,
+                      "memory_count": 10 * payload_size},
+            "connectionbus": {
+                "insert": 10, "transaction": 100, "update": 20, "select": 500, "delete": 5,
+            },
+        },
+        "server_statistics": {
+            "threadpool": {
+                "threads_priority": 5,
+                "max_threads": 254,
+                "min_threads": 8,
+                "max_idle_time_s": 60,
+                "max_queued": -1,
+                "threads": 12,
+                "idle_threads": 4,
+                "max_stop_time_s": 30,
+            },
+            "jetty": {
+                "max_idle_time_s": 200,
+                "current_connections": 3,
+                "max_connections": 0,
+                "max_idle_time_s_low_resources": 1,
+            },
+        },
+    }
+
+
+class FakeAdminServer:
+    """
+    A local HTTP server which speaks the admin API protocol of the Mendix
+    Runtime, answering with canned or generated feedback. It can be used to
+    exercise and benchmark M2EEClient, munin and nagios without running a
+    real application.
+
+    feedback maps action names to the feedback to return, or to a function
+    that gets the request params and returns the feedback. It is used on top
+    of default_feedback(payload_size). Actions that have no feedback are
+    answered with ERR_ACTION_NOT_FOUND. latency is the amount of seconds to
+    wait before responding, either for all actions, or as a dict per action.
+    """
+
+    def __init__(self, password, feedback=None, latency=0, payload_size=10,
+                 host='127.0.0.1', port=0):
+        self.feedback = default_feedback(payload_size)
+        self.feedback["get_admin_action_info"] = self._action_info
+        if feedback is not None:
+            self.feedback.update(feedback)
+        self.latency = latency
+        self.requests = []
+        self._authentication = b64encode(bytearray(password, 'utf-8')).decode('ascii')
+        self._lock = threading.Lock()
+        self._httpd = _ThreadingHTTPServer((host, port), _AdminRequestHandler)
+        self._httpd.admin_server = self
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    @property
+    def url(self):
+        return "http://%s:%s/" % self._httpd.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        logger.debug("Fake admin API listening on %s" % self.url)
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _action_info(self, params):
+        return {"action_info": dict((action, {}) for action in self.feedback)}
+
+    def _latency(self, action):
+        if isinstance(self.latency, dict):
+            return self.latency.get(action, 0)
+        return self.latency
+
+    def handle(self, authentication, body):
+        """
+        Returns the response to a request with the given authentication header
+        and json request body, as a dict.
+        """
+        if authentication != self._authentication:
+            return {"result": M2EEAdminException.ERR_FORBIDDEN,
+                    "message": "Invalid password"}
+        try:
+            request = json.loads(body)
+            action = request['action']
+        except (ValueError, KeyError, TypeError):
+            return {"result": M2EEAdminException.ERR_READ_REQUEST,
+                    "message": "Unable to read request"}
+        with self._lock:
+            self.requests.append(action)
+        latency = self._latency(action)
+        if latency:
+            time.sleep(latency)
+        if action not in self.feedback:
+            return {"result": M2EEAdminException.ERR_ACTION_NOT_FOUND,
+                    "message": "Action %s not found" % action}
+        feedback = self.feedback[action]
+        if callable(feedback):
+            feedback = feedback(request.get('params', {}))
+        return {"result": 0, "feedback": feedback}
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _AdminRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't let the body wait for
+    # the acknowledgement of the headers
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.trace("Fake admin API: " + format % args)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        if self.headers.get('Content-Type') != 'application/json':
+            response = {"result": M2EEAdminException.ERR_CONTENT_TYPE,
+                        "message": "Content type must be application/json"}
+        else:
+            response = self.server.admin_server.handle(
+                self.headers.get('X-M2EE-Authentication'), body)
+        self._respond(response)
+
+    def do_GET(self):
+        self._respond({"result": M2EEAdminException.ERR_HTTP_METHOD,
+                       "message": "Only POST requests are allowed"})
+
+    def _respond(self, response):
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
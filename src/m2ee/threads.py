@@ -0,0 +1,67 @@
+#
+# Copyright (C) 2009 Mendix. All rights reserved.
+#
+
+from __future__ import print_function
+import os
+import sys
+
+STATE_RUNNING = 'running'
+STATE_SLEEPING = 'sleeping'
+STATE_DISK_WAIT = 'disk_wait'
+STATE_OTHER = 'other'
+
+states = (STATE_RUNNING, STATE_SLEEPING, STATE_DISK_WAIT, STATE_OTHER)
+
+# see proc(5), the third field of /proc/<pid>/task/<tid>/stat
+_scheduler_states = {
+    'R': STATE_RUNNING,
+    'S': STATE_SLEEPING,
+    'I': STATE_SLEEPING,
+    'D': STATE_DISK_WAIT,
+}
+
+
+def get_thread_states(pid):
+    """
+    Counts the threads of process pid by scheduler state, by looking at
+    /proc instead of asking the JVM for a thread dump. Returns None when the
+    information is not available.
+    """
+    task_dir = '/proc/%s/task' % pid
+    try:
+        tids = os.listdir(task_dir)
+    except EnvironmentError:
+        return None
+    result = dict((state, 0) for state in states)
+    for tid in tids:
+        state = _load_task_state(os.path.join(task_dir, tid, 'stat'))
+        # threads can disappear while we're looking
+        if state is not None:
+            result[_scheduler_states.get(state, STATE_OTHER)] += 1
+    return result
+
+
+def _load_task_state(filename):
+    try:
+        with open(filename) as f:
+            return _parse_stat_state(f.read())
+    except EnvironmentError:
+        return None
+
+
+def _parse_stat_state(line):
+    # The thread name is between parentheses and can contain anything,
+    # including spaces and parentheses, so look for the last one.
+    fields = line[line.rfind(')') + 1:].split()
+    return fields[0] if fields else None
+
+
+if __name__ == "__main__":
+    thread_states = get_thread_states(sys.argv[1])
+    if thread_states is None:
+        print("No thread information available for pid %s" % sys.argv[1])
+        sys.exit(1)
+    for state in states:
+        print("%s: %s" % (state, thread_states[state]))
+    print("total: %s" % sum(thread_states.values()))
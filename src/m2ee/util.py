@@ -177,3 +177,20 @@ def cleanup_runtimes_except(versions, runtimes_path):
         full_path = os.path.join(runtimes_path, item_to_remove)
         logger.info("Removing %s..." % item_to_remove)
         shutil.rmtree(full_path, ignore_errors=True)
+
+
+def write_atomically(filename, text):
+    """
+    Replaces the contents of filename with text. The text is written to a
+    temporary file next to it first, which is renamed afterwards, so readers
+    never see a partially written file.
+    """
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % os.path.basename(filename),
+                               dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.rename(tmp, filename)
+    except Exception:
+        os.unlink(tmp)
+        raise